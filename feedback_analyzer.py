@@ -1,36 +1,70 @@
 """
 Provides LLM-powered analysis of user feedback for generated code.
 """
-from typing import List, Dict, Any
-from collections import defaultdict
+import asyncio
+import threading
+from typing import List, Dict, Any, Tuple, Iterator, Optional, Callable
 
-from main import query_llm
+import pandas as pd
+from transformers import pipeline
+
+from main import query_llm, query_llm_async, stream_llm
+from semantic_cache import SemanticCache
+
+FEEDBACK_CATEGORIES = ["Code Quality", "Performance", "Readability", "Documentation", "Functionality", "Best Practices"]
+# Number of comments marshaled into a single categorization prompt
+CATEGORIZE_BATCH_SIZE = 20
+# Maximum length of the response summary included for each categorized comment
+CATEGORIZE_SUMMARY_CHARS = 200
+# Upper bound on concurrent requests so a single local Ollama worker isn't saturated
+MAX_CONCURRENT_REQUESTS = 8
+# Embeddings of already categorized comments and their categories
+CATEGORY_CACHE_PATH = "logs/cat_cache.npz"
+# Feedback rated at or below this is analyzed by default
+LOW_RATING_THRESHOLD = 3
+# Local classifier used to pick categories without a generative LLM call
+ZERO_SHOT_MODEL = "facebook/bart-large-mnli"
+ZERO_SHOT_THRESHOLD = 0.4
+
+_zero_shot_classifier = None
+_zero_shot_classifier_lock = threading.Lock()
+
+def _get_zero_shot_classifier():
+    """Get or load the zero-shot classification pipeline."""
+    global _zero_shot_classifier
+
+    if _zero_shot_classifier is None:
+        with _zero_shot_classifier_lock:
+            if _zero_shot_classifier is None:
+                _zero_shot_classifier = pipeline("zero-shot-classification", model=ZERO_SHOT_MODEL)
+    return _zero_shot_classifier
+
+def is_low_rating(entry: Dict[str, Any]) -> bool:
+    """Whether a feedback entry has a rating of LOW_RATING_THRESHOLD or below."""
+    return entry.get('rating', 0) <= LOW_RATING_THRESHOLD
 
 class FeedbackAnalyzer:
     """Uses LLM to analyze feedback comments and generate insights about code quality and user satisfaction."""
     
-    def __init__(self, model: str = "mistral"):
+    def __init__(self, model: str = "mistral", cache: bool = True, local_classifier: bool = True):
         self.model = model
+        self.cache = cache
+        self.local_classifier = local_classifier
+        self._category_cache = SemanticCache(CATEGORY_CACHE_PATH) if cache else None
 
-    def analyze_feedback(self, feedback_entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def analyze_feedback(self, feedback_entries: List[Dict[str, Any]],
+                         predicate: Optional[Callable[[Dict[str, Any]], bool]] = is_low_rating) -> Dict[str, Any]:
         """
         Analyze a collection of feedback entries to generate insights.
         Args: feedback_entries: List of feedback entries from FeedbackManager
+              predicate: Only entries it accepts are analyzed (default: low ratings), None analyzes all
         Returns: Dict containing various analysis results
         """
+        if predicate is not None:
+            feedback_entries = [entry for entry in feedback_entries if predicate(entry)]
         if not feedback_entries:
             return {"error": "No feedback entries to analyze"}
-            
-        prompt = "Analyze the following feedbacks to provide insights and/or summary about the code quality and user satisfaction to the users.\n"
-        i = 1
-        for entry in feedback_entries:
-            if entry.get('comment'):
-                prompt += (f"- User Prompt {i}: {entry.get('prompt')}, Response Generated: {entry.get('code_description')}, "
-                f"Code Generated: {entry.get('code')}, Rating: {entry.get('rating')}, Comment: {entry.get('comment')}, "
-                f"Models Used: {entry.get('code_model')}, {entry.get('chat_model')}\n")
-                i += 1
-        prompt += "Return a json object with only the following keys: 'common_themes', 'areas_for_improvement', 'what_users_like', 'suggestions'"
-        return query_llm(prompt, self.model)
+        return query_llm(self._analysis_prompt(feedback_entries), self.model, response_format="json", cache=self.cache)
 
     def generate_improvement_suggestions(self, code: str, code_description: str, feedback: str, prompt: str = "") -> Dict[str, Any]:
         """
@@ -40,54 +74,170 @@ class FeedbackAnalyzer:
               prompt: The original prompt that generated the code
         Returns: Dict containing categorized improvement suggestions
         """
-        full_prompt = (f"Analyze the response from LLM and the feedback given by the user:\n"
-                      f"PROMPT GIVEN BY USER:\n"
-                      f"{prompt or 'Not provided'}\n"
-                      f"RESPONSE GENERATED BY LLM:\n"
-                      f"{code_description or 'Not provided'}\n"
-                      f"CODE GENERATED BY LLM:\n"
-                      f"{code or 'Not provided'}\n"
-                      f"FEEDBACK GIVEN ON THE RESPONSE:\n"
-                      f"{feedback or 'Not provided'}\n"
-                      f"Provide guidance on how to improve the response based on the prompt and feedback. "
-                      "Return a json object with key 'suggestions' with a list of suggestions as values")
-        return query_llm(full_prompt, self.model)
+        full_prompt = self._suggestions_prompt(code, code_description, feedback, prompt)
+        return query_llm(full_prompt, self.model, response_format="json", cache=self.cache)
+
+    def generate_improvement_suggestions_stream(self, code: str, code_description: str, feedback: str,
+                                                prompt: str = "") -> Iterator[str]:
+        """
+        Streaming variant of generate_improvement_suggestions.
+        Returns: Iterator over chunks of the JSON suggestions text, parse with parse_llm_json once complete
+        """
+        full_prompt = self._suggestions_prompt(code, code_description, feedback, prompt)
+        yield from stream_llm(full_prompt, self.model, response_format="json", cache=self.cache)
+
+    @staticmethod
+    def _analysis_prompt(feedback_entries: List[Dict[str, Any]]) -> str:
+        """Build the prompt asking for insights over all commented feedback entries."""
+        header = "Analyze the following feedbacks to provide insights and/or summary about the code quality and user satisfaction to the users.\n"
+        footer = "Return a json object with only the following keys: 'common_themes', 'areas_for_improvement', 'what_users_like', 'suggestions'"
+        parts = [(f"- User Prompt {i}: {entry.get('prompt')}, Response Generated: {entry.get('code_description')}, "
+                  f"Code Generated: {entry.get('code')}, Rating: {entry.get('rating')}, Comment: {entry.get('comment')}, "
+                  f"Models Used: {entry.get('code_model')}, {entry.get('chat_model')}\n")
+                 for i, entry in enumerate((e for e in feedback_entries if e.get('comment')), 1)]
+        return header + "".join(parts) + footer
+
+    @staticmethod
+    def _suggestions_prompt(code: str, code_description: str, feedback: str, prompt: str) -> str:
+        """Build the prompt asking for improvements to a single response."""
+        return (f"Analyze the response from LLM and the feedback given by the user:\n"
+                f"PROMPT GIVEN BY USER:\n"
+                f"{prompt or 'Not provided'}\n"
+                f"RESPONSE GENERATED BY LLM:\n"
+                f"{code_description or 'Not provided'}\n"
+                f"CODE GENERATED BY LLM:\n"
+                f"{code or 'Not provided'}\n"
+                f"FEEDBACK GIVEN ON THE RESPONSE:\n"
+                f"{feedback or 'Not provided'}\n"
+                f"Provide guidance on how to improve the response based on the prompt and feedback. "
+                "Return a json object with key 'suggestions' with a list of suggestions as values")
 
     def categorize_feedback(self, feedback_entries: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+        """Synchronous wrapper around categorize_feedback_async."""
+        return asyncio.run(self.categorize_feedback_async(feedback_entries))
+
+    async def categorize_feedback_async(self, feedback_entries: List[Dict[str, Any]],
+                                        concurrency: int = MAX_CONCURRENT_REQUESTS) -> Dict[str, List[str]]:
         """
-        Categorize feedback comments into themes.        
+        Categorize feedback comments into themes.
+        Comments similar to an already categorized one are answered from the semantic cache. The rest are
+        labelled by the local zero-shot classifier or, when it is disabled, marshaled into batches of
+        CATEGORIZE_BATCH_SIZE that are sent to the LLM concurrently, at most `concurrency` at a time.
         Args: feedback_entries: List of feedback entries
+              concurrency: Maximum number of in-flight LLM requests
         Returns: Dict mapping categories to lists of feedback
         """
-        categories = defaultdict(list)
-        
-        for entry in feedback_entries:
-            if not entry.get('comment'):
-                categories["Feedbacks Missing"].append({
-                    'code_id': entry['code_id'],
-                    'rating': entry['rating'],
-                    'timestamp': entry['timestamp'][4:16]
-                })
-                continue
-                
-            prompt = (f"Categorize this feedback into one of the following categories [Code Quality, Performance, Readability, Documentation, Functionality, Best Practices]\n"
-                      f"FEEDBACK ON RESPONSE: {entry['comment']} ,RESPONSE: {entry.get('code', 'Not provided')} ,PROMPT GIVEN: {entry.get('prompt', 'Not provided')} \n"
-                      "Return only one category name as a list.")
-            result = query_llm(prompt, self.model)
-            if isinstance(result, list):
-                for category in result:
-                    categories[category].append({
-                        'code_id': entry['code_id'],
-                        'comment': entry['comment'],
-                        'rating': entry['rating'],
-                        'timestamp': entry['timestamp'][:16]
-                    })
-            else:
-                categories["Uncategorized"].append({
-                    'code_id': entry['code_id'],
-                    'comment': entry['comment'],
-                    'rating': entry['rating'],
-                    'timestamp': entry['timestamp'][:16]
-                })
-                
+        if not feedback_entries:
+            return {}
+
+        df = pd.DataFrame(feedback_entries)
+        if 'comment' not in df.columns:
+            df['comment'] = ""
+        has_comment = df['comment'].fillna("").astype(bool)
+        categories = {}
+
+        missing = df.loc[~has_comment, ['code_id', 'rating']].assign(timestamp=df['timestamp'].str.slice(4, 16))
+        if not missing.empty:
+            categories["Feedbacks Missing"] = missing.to_dict('records')
+
+        numbered = [(i, feedback_entries[i]) for i in df.index[has_comment]]
+
+        # Near-duplicate comments reuse the categories already assigned to a similar comment
+        assigned = {}
+        embeddings = {}
+        misses = numbered
+        if self._category_cache is not None and numbered:
+            vectors = self._category_cache.embed([entry['comment'] for _, entry in numbered])
+            misses = []
+            for (i, entry), vector in zip(numbered, vectors):
+                cached = self._category_cache.lookup(vector)
+                if cached is not None:
+                    assigned[i] = cached
+                else:
+                    embeddings[i] = vector
+                    misses.append((i, entry))
+
+        if not misses:
+            new_assignments = {}
+        elif self.local_classifier:
+            new_assignments = await asyncio.to_thread(self._classify_locally, misses)
+        else:
+            new_assignments = await self._classify_with_llm(misses, concurrency)
+
+        for i, result_categories in new_assignments.items():
+            assigned[i] = result_categories
+            if i in embeddings:
+                self._category_cache.add(embeddings[i], result_categories)
+        if embeddings:
+            self._category_cache.save()
+
+        commented = df.loc[has_comment, ['code_id', 'comment', 'rating']].assign(
+            timestamp=df['timestamp'].str.slice(0, 16),
+            category=[assigned.get(i) or ["Uncategorized"] for i, _ in numbered],
+        ).explode('category')
+        for category, rows in commented.groupby('category', sort=False):
+            categories[category] = rows.drop(columns='category').to_dict('records')
+
         return dict(categories)
+
+    def _classify_locally(self, numbered: List[Tuple[int, Dict[str, Any]]]) -> Dict[int, List[str]]:
+        """Assign categories with the local zero-shot classifier in a single batched forward pass."""
+        classifier = _get_zero_shot_classifier()
+        results = classifier([entry['comment'] for _, entry in numbered],
+                             candidate_labels=FEEDBACK_CATEGORIES, multi_label=True)
+        if isinstance(results, dict):
+            results = [results]
+
+        assigned = {}
+        for (i, _), result in zip(numbered, results):
+            labels = [label for label, score in zip(result['labels'], result['scores'])
+                      if score > ZERO_SHOT_THRESHOLD]
+            if labels:
+                assigned[i] = labels
+        return assigned
+
+    async def _classify_with_llm(self, numbered: List[Tuple[int, Dict[str, Any]]],
+                                 concurrency: int) -> Dict[int, List[str]]:
+        """Assign categories by sending marshaled batches to the LLM, at most `concurrency` at a time."""
+        batches = [numbered[start:start + CATEGORIZE_BATCH_SIZE]
+                   for start in range(0, len(numbered), CATEGORIZE_BATCH_SIZE)]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _one(batch):
+            async with semaphore:
+                return await query_llm_async(self._categorization_prompt(batch), self.model,
+                                             response_format="json_array", cache=self.cache)
+
+        assigned = {}
+        for result in await asyncio.gather(*(_one(batch) for batch in batches)):
+            assigned.update(self._categories_by_index(result))
+        return assigned
+
+    @staticmethod
+    def _categorization_prompt(batch: List[Tuple[int, Dict[str, Any]]]) -> str:
+        """Marshal a batch of (index, entry) pairs into a single categorization prompt."""
+        lines = [f"Categorize each of the following feedbacks into one of the categories [{', '.join(FEEDBACK_CATEGORIES)}]\n"]
+        for i, entry in batch:
+            # The category depends on the comment; a one-line summary of the response is enough context,
+            # and leaving out the generated code keeps the prompt (and Ollama's prefill) short
+            summary = (entry.get('code_description') or 'Not provided').strip().split("\n", 1)[0][:CATEGORIZE_SUMMARY_CHARS]
+            lines.append(f"#{i}: FEEDBACK ON RESPONSE: {entry['comment']} ,RESPONSE SUMMARY: {summary} "
+                         f",PROMPT GIVEN: {entry.get('prompt', 'Not provided')}\n")
+        lines.append("Return a JSON object with the key 'results' holding an array of objects with the keys 'index' "
+                     "(the number after #) and 'categories' (a list with one category name), one object per feedback.")
+        return "".join(lines)
+
+    @staticmethod
+    def _categories_by_index(result: Any) -> Dict[int, List[str]]:
+        """Map each index in a batched categorization response to its list of categories."""
+        assigned = {}
+        if not isinstance(result, list):
+            return assigned
+        for item in result:
+            if not isinstance(item, dict) or not isinstance(item.get('categories'), list):
+                continue
+            try:
+                assigned[int(item.get('index'))] = item['categories']
+            except (TypeError, ValueError):
+                continue
+        return assigned
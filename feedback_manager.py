@@ -2,38 +2,100 @@
 Manages user feedback collection and visualization for generated code.
 """
 import os
-import json
+import orjson
+import asyncio
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Set, Iterable
+import numpy as np
 import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
-from feedback_analyzer import FeedbackAnalyzer
+from matplotlib.figure import Figure
+from feedback_analyzer import FeedbackAnalyzer, LOW_RATING_THRESHOLD
+from main import parse_llm_json
+from model_evaluator import figure_png
+
+FEEDBACK_LOG_PATH = "logs/user_feedback.jsonl"
+# Seconds between two writes of the buffered feedback entries to the log
+FLUSH_INTERVAL = 0.5
+
+# Worker pool for LLM analyses, created on first use; the lock keeps concurrent sessions from creating two
+_analysis_pool = None
+_analysis_pool_lock = threading.Lock()
+
 
 class FeedbackManager:
     """
     A class to collect, store, and analyze user feedback on generated code.
     """
 
-    def __init__(self, log_path: str = "logs/user_feedback.json"):
+    def __init__(self, log_path: str = FEEDBACK_LOG_PATH):
         """
         Initialize the FeedbackManager.
 
         Args:
-            log_path: Path to store feedback logs
+            log_path: Path to store feedback logs (JSON Lines, one entry per line)
         """
         self.log_path = log_path
         self._ensure_log_file_exists()
+        self._migrate_legacy_log()
+        self._code_ids: Optional[Set[str]] = None
+        # A manager is shared by every Streamlit session (see get_feedback_manager)
+        self._lock = threading.Lock()
+        self._writer = _LogWriter(log_path)
+        # Stop the writer's thread and write what it didn't get to once the manager is released,
+        # e.g. when get_feedback_manager's cache is cleared, or when the process exits
+        self._finalizer = weakref.finalize(self, self._writer.close)
 
     def _ensure_log_file_exists(self):
         """Ensure the log file and directory exist."""
-        log_dir = os.path.dirname(self.log_path)
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+        # Both steps are atomic, so concurrent sessions can't race between a check and the creation
+        Path(self.log_path).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            open(self.log_path, 'x').close()
+        except FileExistsError:
+            pass
+
+    def _migrate_legacy_log(self):
+        """
+        Convert the feedback saved as a single JSON array in the .json log used before JSON Lines, once:
+        only into an empty log, and the old file is renamed to .json.migrated.
+        """
+        legacy_path = os.path.splitext(self.log_path)[0] + ".json"
+        if legacy_path == self.log_path or not os.path.exists(legacy_path) or os.path.getsize(self.log_path):
+            return
+        migrated_path = legacy_path + ".migrated"
+        try:
+            # Only one process can rename the file, so the entries aren't converted twice
+            os.rename(legacy_path, migrated_path)
+        except OSError:
+            return
+        try:
+            with open(migrated_path, 'rb') as f:
+                entries = orjson.loads(f.read())
+            with open(self.log_path, 'ab') as f:
+                f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in entries))
+        except Exception as e:
+            print(f"Error converting the feedback log: {e}")
 
-        if not os.path.exists(self.log_path):
-            with open(self.log_path, 'w') as f:
-                json.dump([], f)
+    def flush(self):
+        """Write the buffered feedback entries to the log now, e.g. before reading it."""
+        self._writer.flush()
+
+    def close(self):
+        """Stop the background writes, writing the buffered feedback entries."""
+        self._finalizer()
+
+    def _load_index(self) -> Set[str]:
+        """Load the set of code IDs with recorded feedback, reading the log only once."""
+        with self._lock:
+            if self._code_ids is None:
+                self._code_ids = {entry.get("code_id") for entry in self.load_feedback(self.log_path)}
+            return self._code_ids
 
     def is_feedback_recorded(self, code_id: str) -> bool:
         """
@@ -45,17 +107,21 @@ class FeedbackManager:
         Returns:
             bool: True if feedback has already been recorded for this code ID
         """
-        try:
-            with open(self.log_path, 'r') as f:
-                feedbacks = json.load(f)
+        return code_id in self._load_index()
 
-            # Check if any feedback entry has this code_id
-            for entry in feedbacks:
-                if entry.get("code_id") == code_id:
-                    return True
-            return False
-        except Exception as e:
-            return False
+    def bulk_is_recorded(self, code_ids: Iterable[str]) -> Set[str]:
+        """
+        Check which of several code IDs already have recorded feedback, in a single lookup.
+
+        Args:
+            code_ids: Identifiers for the codes to check
+
+        Returns:
+            Set[str]: The code IDs with recorded feedback
+        """
+        code_id_index = self._load_index()
+        with self._lock:
+            return code_id_index.intersection(code_ids)
 
     def record_feedback(self,
                         feedback_rating: int,
@@ -67,7 +133,8 @@ class FeedbackManager:
                         prompt: Optional[str] = None,
                         code_description: Optional[str] = None) -> bool:
         """
-        Record user feedback for a generated code.
+        Record user feedback for a generated code. The entry is buffered and appended to the log
+        by a background thread within FLUSH_INTERVAL seconds; the index of rated code IDs is updated right away.
 
         Args:
             feedback_rating: User rating (1-5)
@@ -82,8 +149,9 @@ class FeedbackManager:
         Returns:
             bool: True if feedback was successfully recorded
         """
-        # Check if feedback already exists for this code_id
-        if self.is_feedback_recorded(code_id):
+        # Check if feedback already exists for this code_id; the index is parsed at most once per manager
+        code_ids = self._load_index()
+        if code_id in code_ids:
             return True
 
         feedback_entry = {
@@ -99,40 +167,187 @@ class FeedbackManager:
         }
 
         try:
-            with open(self.log_path, 'r') as f:
-                feedbacks = json.load(f)
-            feedbacks.append(feedback_entry)
-            with open(self.log_path, 'w') as f:
-                json.dump(feedbacks, f, indent=2)
+            line = orjson.dumps(feedback_entry) + b"\n"
+            with self._lock:
+                # Another session may have rated the same code meanwhile
+                if code_id in code_ids:
+                    return True
+                self._writer.append(line)
+                code_ids.add(code_id)
             return True
         except Exception as e:
             return False
 
     @classmethod
-    def load_feedback(cls) -> List[Dict[str, Any]]:
+    def load_feedback(cls, log_path: str = FEEDBACK_LOG_PATH) -> List[Dict[str, Any]]:
         """Load all saved feedback."""
-        log_path = "logs/user_feedback.json"
         if not os.path.exists(log_path):
             return []
 
         try:
-            with open(log_path, 'r') as f:
-                return json.load(f)
+            with open(log_path, 'rb') as f:
+                return [orjson.loads(line) for line in f if line.strip()]
         except Exception:
             return []
 
 
+class _LogWriter:
+    """
+    Appends buffered lines to a log in a single write every FLUSH_INTERVAL seconds, from a background thread.
+    It holds no reference to its FeedbackManager, so the manager can be released and close it.
+    """
+
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self._pending = deque()  # lines not yet written
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def append(self, line: bytes):
+        """Buffer a line, written by the next flush."""
+        self._pending.append(line)
+
+    def _run(self):
+        """Flush every FLUSH_INTERVAL seconds until the writer is closed."""
+        while not self._stop.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """Append the buffered lines to the log in a single write."""
+        with self._flush_lock:
+            lines = []
+            while self._pending:
+                lines.append(self._pending.popleft())
+            if not lines:
+                return
+            try:
+                with open(self.log_path, 'ab') as f:
+                    f.write(b"".join(lines))
+            except Exception as e:
+                print(f"Error writing feedback to the log: {e}")
+                # Keep the lines, in order, for the next flush
+                self._pending.extendleft(reversed(lines))
+
+    def close(self):
+        """Stop the background thread and write the buffered lines."""
+        self._stop.set()
+        self.flush()
+
+
+@st.cache_resource
+def get_feedback_manager() -> FeedbackManager:
+    """The FeedbackManager shared by every session, so its index of rated code IDs is loaded once per process."""
+    return FeedbackManager()
+
+
+def _log_mtime(log_path: str) -> float:
+    """Modification time of the log, used to invalidate the cached data when feedback is added."""
+    return os.path.getmtime(log_path) if os.path.exists(log_path) else 0.0
+
+
+@st.cache_data(show_spinner=False)
+def _load_feedbacks(log_path: str, mtime: float) -> List[Dict[str, Any]]:
+    """Load the feedback log, reusing the parsed entries until the file changes."""
+    return FeedbackManager.load_feedback(log_path)
+
+
+@st.cache_data(show_spinner=False)
+def _load_df(log_path: str, mtime: float) -> pd.DataFrame:
+    """Load the feedback log as a DataFrame, reusing it until the file changes."""
+    return pd.DataFrame(_load_feedbacks(log_path, mtime))
+
+
+@st.cache_data(show_spinner=False)
+def _rating_counts(df: pd.DataFrame) -> pd.Series:
+    """Number of feedback entries per rating, from 1 to 5."""
+    # Entries migrated from the legacy log may have a missing or out-of-range rating; they aren't counted
+    ratings = pd.to_numeric(df["rating"], errors="coerce").dropna()
+    ratings = ratings[ratings.between(1, 5)]
+    # Ratings are small integers, so a single counting pass beats value_counts' hash table
+    counts = np.bincount(ratings.to_numpy(dtype=np.int64), minlength=6)
+    return pd.Series(counts[1:6], index=range(1, 6))
+
+
+@st.cache_data(show_spinner=False)
+def _ratings_by_model(df: pd.DataFrame, model_col: str) -> pd.DataFrame:
+    """Average rating ('mean') and number of ratings ('count') per model, in a single groupby pass."""
+    return df.groupby(model_col)["rating"].agg(["mean", "count"])
+
+
+@st.cache_data(show_spinner=False)
+def _categorize_feedback(model: str, feedbacks: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """LLM categories for a list of feedback entries, memoized on the entries."""
+    return asyncio.run(FeedbackAnalyzer(model).categorize_feedback_async(feedbacks))
+
+
+def _get_analysis_pool() -> ThreadPoolExecutor:
+    """Get or create the worker pool running feedback analyses off the Streamlit script thread."""
+    global _analysis_pool
+
+    if _analysis_pool is None:
+        with _analysis_pool_lock:
+            if _analysis_pool is None:
+                _analysis_pool = ThreadPoolExecutor(max_workers=2)
+    return _analysis_pool
+
+
+def _render_analysis(polling: bool):
+    """Render the background feedback analysis, or a placeholder while it is still running."""
+    future = st.session_state.analyze_future
+    if not future.done():
+        st.info("Analyzing feedback... You can keep using the dashboard in the meantime.")
+        return
+    if polling:
+        # A full rerun renders the result in a fragment that no longer polls
+        st.rerun()
+
+    try:
+        analysis_results = future.result()
+        if "error" in analysis_results:
+            st.error(f"Analysis failed: {analysis_results['error']}")
+        else:
+            # Display common themes
+            if analysis_results.get("common_themes", []):   
+                st.write("### Common Themes")
+                for theme in analysis_results.get("common_themes", []):
+                    st.write(f"- {theme}")
+
+            # Display areas for improvement
+            if analysis_results.get("areas_for_improvement", []):
+                st.write("### Areas for Improvement")
+                for area in analysis_results.get("areas_for_improvement", []):
+                    st.write(f"- {area}")
+
+            # Display what users like
+            if analysis_results.get("what_users_like", []):
+                st.write("### What Users Like")
+                for like in analysis_results.get("what_users_like", []):
+                    st.write(f"- {like}")
+
+            # Display suggestions
+            if analysis_results.get("suggestions", []):
+                st.write("### Suggestions for Improvement")
+                for suggestion in analysis_results.get("suggestions", []):
+                    st.write(f"- {suggestion}")
+    except Exception as e:
+        st.error(f"Analysis failed: {e}")
+
+
 def render_feedback_dashboard(model: str = "mistral"):
     """Render the feedback analysis dashboard in Streamlit."""
     st.header("User Feedback Dashboard")
-    feedbacks = FeedbackManager.load_feedback()
+    # Write the buffered feedback first, so a rating just given is part of the log read below
+    get_feedback_manager().flush()
+    mtime = _log_mtime(FEEDBACK_LOG_PATH)
+    feedbacks = _load_feedbacks(FEEDBACK_LOG_PATH, mtime)
 
     if not feedbacks:
         st.info("No user feedback has been collected yet.")
         return
 
     # Convert to DataFrame for easier analysis
-    df = pd.DataFrame(feedbacks)
+    df = _load_df(FEEDBACK_LOG_PATH, mtime)
 
     # Overall metrics
     col1, col2, col3 = st.columns(3)
@@ -158,43 +373,36 @@ def render_feedback_dashboard(model: str = "mistral"):
     ])
     
     with analysis_tab:
+        # Analyzing only the feedback that needs attention keeps the prompt (and the LLM work) small
+        analyze_all = st.checkbox("Analyze all feedback", value=False)
+        filter_col1, filter_col2 = st.columns(2)
+        with filter_col1:
+            selected_ratings = st.multiselect("Ratings to analyze", options=[1, 2, 3, 4, 5],
+                                              default=list(range(1, LOW_RATING_THRESHOLD + 1)),
+                                              disabled=analyze_all)
+        with filter_col2:
+            since = st.date_input("Feedback since", value=None, disabled=analyze_all)
+
+        if analyze_all:
+            selected_feedbacks = feedbacks
+        else:
+            selected_feedbacks = [entry for entry in feedbacks
+                                  if entry['rating'] in selected_ratings
+                                  and (since is None or entry['timestamp'][:10] >= since.isoformat())]
+
         if st.button("Generate insights about the feedbacks given by users"):
-            with st.spinner("Analyzing feedback..."):
-                analysis_results = analyzer.analyze_feedback(feedbacks)
-                try:
-                    if "error" in analysis_results:
-                        st.error(f"Analysis failed: {analysis_results['error']}")
-                    else:
-                        # Display common themes
-                        if analysis_results.get("common_themes", []):   
-                            st.write("### Common Themes")
-                            for theme in analysis_results.get("common_themes", []):
-                                st.write(f"- {theme}")
-
-                        # Display areas for improvement
-                        if analysis_results.get("areas_for_improvement", []):
-                            st.write("### Areas for Improvement")
-                            for area in analysis_results.get("areas_for_improvement", []):
-                                st.write(f"- {area}")
-                            
-                        # Display what users like
-                        if analysis_results.get("what_users_like", []):
-                            st.write("### What Users Like")
-                            for like in analysis_results.get("what_users_like", []):
-                                st.write(f"- {like}")
-                            
-                        # Display suggestions
-                        if analysis_results.get("suggestions", []):
-                            st.write("### Suggestions for Improvement")
-                            for suggestion in analysis_results.get("suggestions", []):
-                                st.write(f"- {suggestion}")
-                except Exception as e:
-                    st.error(f"Analysis failed: {e}")
-    
+            # The LLM call runs in a worker thread so the rest of the UI stays responsive
+            st.session_state.analyze_future = _get_analysis_pool().submit(
+                FeedbackAnalyzer(model).analyze_feedback, selected_feedbacks, None)
+
+        if st.session_state.get("analyze_future") is not None:
+            polling = not st.session_state.analyze_future.done()
+            st.fragment(run_every=1 if polling else None)(_render_analysis)(polling)
+
     with categories_tab:
         if st.button("Categorize the feedbacks given by users"):
             with st.spinner("Categorizing feedback..."):
-                categories = analyzer.categorize_feedback(feedbacks)
+                categories = _categorize_feedback(model, feedbacks)
                 for category, comments in categories.items():
                     try:    
                         with st.expander(f"{category} ({len(comments)})"):
@@ -210,40 +418,26 @@ def render_feedback_dashboard(model: str = "mistral"):
                                              format_func=lambda x: f"Rating: {feedbacks[x]['rating']} - Comment: {feedbacks[x]['comment'][:50] + '...' if feedbacks[x]['comment'] else 'No comment'}")
             
             if st.button("Generate suggestions for improvement of the selected feedback"):
-                with st.spinner("Generating suggestions..."):
-                    feedback_entry = feedbacks[selected_feedback]
-                    suggestions = analyzer.generate_improvement_suggestions(feedback_entry.get("code", ""), feedback_entry.get("code_description", ""), feedback_entry.get("comment", ""), feedback_entry.get("prompt", ""))
-                    try:
-                        if "error" in suggestions:
-                            st.error(f"An error occurred while generating suggestions. Please try again.  \nError: {suggestions['error']}")
-                        else:
-                            st.write("### Suggested Improvements")
-                            for suggestion in suggestions['suggestions']:
-                                st.write(f"- {suggestion}")
-                    except Exception as e:
-                        st.error(f"An error occurred while generating suggestions. Please try again.  \nError Summary: {e}")
+                feedback_entry = feedbacks[selected_feedback]
+                stream_placeholder = st.empty()
+                try:
+                    # Show the raw response as it is generated, then replace it with the parsed suggestions
+                    with stream_placeholder.container():
+                        raw_suggestions = st.write_stream(analyzer.generate_improvement_suggestions_stream(feedback_entry.get("code", ""), feedback_entry.get("code_description", ""), feedback_entry.get("comment", ""), feedback_entry.get("prompt", "")))
+                    stream_placeholder.empty()
+                    suggestions = parse_llm_json(raw_suggestions)
+                    if "error" in suggestions:
+                        st.error(f"An error occurred while generating suggestions. Please try again.  \nError: {suggestions['error']}")
+                    else:
+                        st.write("### Suggested Improvements")
+                        for suggestion in suggestions['suggestions']:
+                            st.write(f"- {suggestion}")
+                except Exception as e:
+                    st.error(f"An error occurred while generating suggestions. Please try again.  \nError Summary: {e}")
 
     st.markdown("---")
     st.subheader("Rating Distribution")
-    rating_counts = df["rating"].value_counts().sort_index()
-    fig, ax = plt.subplots(figsize=(10, 5))
-    bars = ax.bar(rating_counts.index, rating_counts.values, color='skyblue')
-    ax.set_xlabel("Rating")
-    ax.set_ylabel("Count")
-    ax.set_title("Distribution of Ratings")
-    ax.set_xticks(range(1, 6))
-    ax.grid(axis='y', linestyle='--', alpha=0.7)
-
-    # Add value labels on top of bars
-    for bar in bars:
-        height = bar.get_height()
-        ax.annotate(f'{height}',
-                    xy=(bar.get_x() + bar.get_width() / 2, height),
-                    xytext=(0, 3),
-                    textcoords="offset points",
-                    ha='center', va='bottom')
-
-    st.pyplot(fig)
+    st.image(_rating_distribution_png(FEEDBACK_LOG_PATH, mtime), use_container_width=True)
 
     # Model comparison
     if "chat_model" in df.columns and "code_model" in df.columns:
@@ -251,16 +445,16 @@ def render_feedback_dashboard(model: str = "mistral"):
         tab1, tab2 = st.tabs(["Chat Models", "Code Models"])
 
         with tab1:
-            _plot_model_ratings(df, "chat_model")
+            _plot_model_ratings(df, mtime, "chat_model")
 
         with tab2:
-            _plot_model_ratings(df, "code_model")
+            _plot_model_ratings(df, mtime, "code_model")
 
     # Recent feedback
     st.subheader("Recent Feedback")
     recent_df = df.sort_values("timestamp", ascending=False).head(10)
 
-    for i, (_, row) in enumerate(recent_df.iterrows()):
+    for row in recent_df.to_dict('records'):
         with st.expander(f"{row['timestamp']} - Rating: {'⭐' * int(row['rating'])}"):
             st.write(f"**Code ID:** {row['code_id']}")
             if "chat_model" in row and "code_model" in row:
@@ -269,25 +463,53 @@ def render_feedback_dashboard(model: str = "mistral"):
                 st.write(f"**Comment:** {row['comment']}")
 
 
-def _plot_model_ratings(df: pd.DataFrame, model_col: str):
+def _plot_model_ratings(df: pd.DataFrame, mtime: float, model_col: str):
     """Plot average ratings for different models."""
-    if model_col not in df.columns:
+    if model_col not in df.columns or df[model_col].isna().all():
         st.info(f"No {model_col} data available.")
         return
+    st.image(_model_ratings_png(FEEDBACK_LOG_PATH, mtime, model_col), use_container_width=True)
 
+
+@st.cache_data(show_spinner=False)
+def _rating_distribution_png(log_path: str, mtime: float) -> bytes:
+    """Chart of the number of feedback entries per rating, drawn once per version of the log."""
+    rating_counts = _rating_counts(_load_df(log_path, mtime))
+    fig = Figure(figsize=(10, 5))
+    ax = fig.add_subplot(111)
+    bars = ax.bar(rating_counts.index, rating_counts.values, color='skyblue')
+    ax.set_xlabel("Rating")
+    ax.set_ylabel("Count")
+    ax.set_title("Distribution of Ratings")
+    ax.set_xticks(range(1, 6))
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+
+    # Add value labels on top of bars
+    for bar in bars:
+        height = bar.get_height()
+        ax.annotate(f'{height}',
+                    xy=(bar.get_x() + bar.get_width() / 2, height),
+                    xytext=(0, 3),
+                    textcoords="offset points",
+                    ha='center', va='bottom')
+    return figure_png(fig)
+
+
+@st.cache_data(show_spinner=False)
+def _model_ratings_png(log_path: str, mtime: float, model_col: str) -> bytes:
+    """Chart of the average rating by model, drawn once per version of the log."""
+    df = _load_df(log_path, mtime)
     # Filter out rows where model info is missing
     df_clean = df[df[model_col].notna()]
 
-    if df_clean.empty:
-        st.info(f"No {model_col} data available.")
-        return
-
     # Average rating by model
-    ratings_by_model = df_clean.groupby(model_col)["rating"].mean()
-    ratings_count = df_clean.groupby(model_col)["rating"].count()
+    ratings = _ratings_by_model(df_clean, model_col)
+    ratings_by_model = ratings["mean"]
+    ratings_count = ratings["count"]
 
-    fig, ax = plt.subplots(figsize=(10, 5))
-    bars = ratings_by_model.plot(kind="bar", ax=ax)
+    fig = Figure(figsize=(10, 5))
+    ax = fig.add_subplot(111)
+    ratings_by_model.plot(kind="bar", ax=ax)
     ax.set_ylim(0, 5)  # Set y-axis to range from 0 to 5
     ax.set_xlabel(f"{model_col.replace('_', ' ').title()}(s)")
     ax.set_ylabel("Average Rating")
@@ -295,6 +517,6 @@ def _plot_model_ratings(df: pd.DataFrame, model_col: str):
 
     # Add count labels
     for i, v in enumerate(ratings_by_model):
-        ax.text(i, v + 0.1, f"n={ratings_count[ratings_by_model.index[i]]}",
+        ax.text(i, v + 0.1, f"n={ratings_count.iloc[i]}",
                 ha='center', va='bottom', fontsize=9)
-    st.pyplot(fig)
\ No newline at end of file
+    return figure_png(fig)
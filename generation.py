@@ -0,0 +1,208 @@
+"""
+Runs code generation for a prompt with retries, independently of how progress is displayed.
+"""
+import asyncio
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Union, Iterator, Callable, Tuple
+
+from main import (generate_code, submit_generation_attempts, start_stream_generation, stream_generation,
+                  finish_generation, generation_breaker, CircuitOpenError)
+from model_evaluator import ModelEvaluator
+from semantic_cache import SemanticCache, ExactCache
+
+MAX_RETRIES = 3
+# Fields every structured response must have
+CODE_OUTPUT_FIELDS = ("code", "description", "filename")
+# Prompt of a retry, given the original prompt and a one-line summary of the previous attempt's error
+RETRY_TMPL = ("Original request: {prompt}  \nPrevious attempt failed with the following error: {error}  \n"
+              "Please generate a correct solution that avoids this error to respond to original request.")
+# Maximum length of the error message in a retry prompt
+ERROR_SUMMARY_LENGTH = 160
+
+
+@dataclass
+class Result:
+    """Outcome of run_generation."""
+    cleaned_json: Optional[Union[Dict[str, Any], str]]  # code output dict, or the raw response if it wasn't one
+    is_json: bool
+    raw: str  # raw response text; on failure, that of the latest attempt that produced one
+    attempts: int
+    cache_layer: Optional[str] = None  # "exact" or "semantic" when the response came from a cache
+    completion_time: float = 0.0
+    error: Optional[str] = None
+    error_traceback: Optional[str] = None
+
+    @property
+    def from_cache(self) -> bool:
+        """Whether the response was reused from an earlier prompt."""
+        return self.cache_layer is not None
+
+    @property
+    def succeeded(self) -> bool:
+        """Whether a response was produced, structured or not."""
+        return self.error is None
+
+
+class GenerationProgress:
+    """
+    Receives progress updates from run_generation. The default implementation ignores them;
+    front ends override the methods to display them.
+    """
+
+    def status(self, message: str):
+        """A new generation step started."""
+
+    def partial(self, code: str):
+        """Code streamed so far by the running attempt."""
+
+    def stream(self, chunks: Iterator[str]) -> str:
+        """Consume the final attempt's streamed answer and return its full text."""
+        return "".join(chunks)
+
+    def retry(self, attempt: int, error_context: str, response: Any):
+        """An attempt failed and the prompt is retried with the error as context."""
+
+    def done(self):
+        """The generation finished, successfully or not."""
+
+
+def run_generation(agent_factory: Callable, output_formatter: Callable[..., str], prompt: str,
+                   model_evaluator: Optional[ModelEvaluator] = None,
+                   prompt_cache: Optional[SemanticCache] = None, cache_threshold: Optional[float] = None,
+                   response_cache: Optional[ExactCache] = None,
+                   direct: Optional[Callable[[str], Tuple[str, Optional[Any]]]] = None, skip_cache: bool = False,
+                   progress: Optional[GenerationProgress] = None, max_retries: int = MAX_RETRIES) -> Result:
+    """
+    Generate code for a prompt, retrying with the previous error as context when an attempt fails.
+    The last attempt is streamed, and accepts a response that isn't structured JSON.
+    Args: agent_factory: Callable creating a fresh agent
+          output_formatter: Streams the agent's answer formatted as JSON (see main.format_code_output)
+          prompt: The user prompt
+          model_evaluator: Evaluator recording the generation, started by the caller
+          prompt_cache: Semantic cache reused for near-identical prompts and filled with new results
+          cache_threshold: Minimum similarity for a prompt cache hit (the cache's own threshold if None)
+          response_cache: Exact-match cache checked before the prompt cache, and filled with new results
+          direct: Answers the prompt without the agent (see main.generate_code_directly); tried before the first
+                  agent attempt, which only runs if it doesn't return a complete code output
+          skip_cache: Generate a new response instead of reusing a cached one; it replaces the cached one
+          progress: Receives progress updates
+          max_retries: Maximum number of attempts
+    Returns: Result: The response, or the last error if every attempt failed
+    """
+    progress = progress or GenerationProgress()
+    started = time.perf_counter()
+
+    # Reuse the response to an identical, then to a near-identical earlier prompt instead of querying the models.
+    # Cache hits would skew the model metrics, so they aren't recorded in the evaluation
+    if response_cache is not None and not skip_cache:
+        cached_response = response_cache.get(prompt)
+        if cached_response is not None:
+            progress.done()
+            return Result(cached_response, True, str(cached_response), 0, cache_layer="exact",
+                          completion_time=time.perf_counter() - started)
+    prompt_embedding = None
+    if prompt_cache is not None:
+        prompt_embedding = prompt_cache.embed([prompt])[0]
+        cached_response = None if skip_cache else prompt_cache.lookup(prompt_embedding, cache_threshold)
+        if cached_response is not None:
+            progress.done()
+            return Result(cached_response, True, str(cached_response), 0, cache_layer="semantic",
+                          completion_time=time.perf_counter() - started)
+
+    retries = 0
+    error_context = ""
+    retry_prompt = prompt
+    prefetched = None
+    # Raw output of the latest attempt that produced one, shown when every attempt failed
+    last_raw_output = None
+    while True:
+        response = None
+        # The attempt started by the previous failure, if any
+        running, prefetched = prefetched, None
+        try:
+            # Fail fast while the LLM server keeps timing out
+            generation_breaker.check()
+
+            if retries == max_retries - 1:
+                # Last chance: stream a single attempt so the answer shows up as it is generated
+                progress.status("Streaming the AI agent's answer...")
+                answer = progress.stream(stream_generation(
+                    running or start_stream_generation(agent_factory(), retry_prompt)))
+                progress.status("Formatting the answer...")
+                raw_response, parsed_response, usage = finish_generation(str(answer), output_formatter)
+            else:
+                parsed_response = usage = None
+                if retries == 0 and direct is not None:
+                    # A simple prompt is first answered by the code model alone, skipping the agent's hops
+                    progress.status("Querying the code model...")
+                    raw_response, parsed_response = direct(prompt)
+                if parsed_response is None:
+                    # Get formatted results from concurrent agent runs, preferring a complete code output
+                    progress.status("Querying AI agent...")
+                    raw_response, parsed_response, usage = asyncio.run(generate_code(
+                        agent_factory, output_formatter, retry_prompt, on_partial=progress.partial,
+                        submitted=running))
+            generation_breaker.record_success()
+            last_raw_output = raw_response
+
+            # Attempts only return a parsed response that is a code output with every field
+            is_json = parsed_response is not None
+            response = parsed_response if is_json else raw_response
+            if not is_json and retries < max_retries - 1:
+                raise ValueError(f"Response is not a JSON object with the fields {', '.join(CODE_OUTPUT_FIELDS)}.")
+            # Recorded here on the script thread, for the accepted attempt only
+            if usage is not None and model_evaluator is not None:
+                model_evaluator.record_token_usage(*usage)
+            break
+
+        except Exception as e:
+            retries += 1
+            error_msg = str(e)
+            if isinstance(e, CircuitOpenError):
+                # Retrying would only fail fast again
+                retries = max_retries
+                if running is not None:
+                    running.cancel()
+                error_context = error_msg
+            elif isinstance(e, TimeoutError):
+                generation_breaker.record_timeout()
+                error_msg = f"LLM timed out: {error_msg}"
+                error_context = f"{error_msg} Answer more concisely, with shorter reasoning and code."
+            else:
+                # Retry prompts get a one-line summary; the model can't use stack frames or long messages
+                summary = error_msg.splitlines()[0][:ERROR_SUMMARY_LENGTH] if error_msg else ""
+                error_context = f"{type(e).__name__}: {summary}"
+
+            if retries >= max_retries:
+                if model_evaluator is not None:
+                    model_evaluator.record_failure(error_context)
+                progress.done()
+                # Only the final error is displayed, so only its traceback is formatted
+                error_traceback = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                return Result(response, False, last_raw_output or "", retries, error=error_msg,
+                              error_traceback=error_traceback)
+
+            # Start the retry right away, so it runs while the failure is recorded and displayed
+            retry_prompt = RETRY_TMPL.format(prompt=prompt, error=error_context)
+            if not generation_breaker.remaining():
+                prefetched = (start_stream_generation(agent_factory(), retry_prompt) if retries == max_retries - 1
+                              else submit_generation_attempts(agent_factory, output_formatter, retry_prompt))
+
+            if model_evaluator is not None:
+                model_evaluator.record_retry(error_context)
+            progress.retry(retries, error_context, response)
+
+    # A raw response is recorded by its text, as code metrics can't be computed on the structure
+    completion_time = time.perf_counter() - started
+    if model_evaluator is not None:
+        completion_time = model_evaluator.record_success(response if is_json else {"code": str(response)})
+    if is_json and response_cache is not None:
+        response_cache.add(prompt, response)
+    if is_json and prompt_cache is not None:
+        prompt_cache.add(prompt_embedding, response)
+        prompt_cache.save()
+
+    progress.done()
+    return Result(response, is_json, raw_response, retries + 1, completion_time=completion_time)
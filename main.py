@@ -1,68 +1,453 @@
 import os
+import asyncio
 import streamlit as st
-import json
-from typing import Dict, Any, Optional, Union, List
+import orjson
+import dirtyjson
+import hashlib
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from functools import partial, lru_cache
+from pathlib import Path
+from typing import Dict, Any, Optional, Union, List, Iterator, Tuple, Callable, Iterable
 
 from llama_index.core.agent import ReActAgent
 from llama_index.core.output_parsers import PydanticOutputParser
-from llama_index.core.query_pipeline import QueryPipeline
 from llama_index.llms.ollama import Ollama
 from llama_parse import LlamaParse
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, PromptTemplate
+from llama_index.core import (VectorStoreIndex, SimpleDirectoryReader, PromptTemplate, StorageContext,
+                              Document, load_index_from_storage)
 from llama_index.core.embeddings import resolve_embed_model
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from pydantic import BaseModel
 from dotenv import load_dotenv
+import diskcache
+import torch
 
 from code_reader import code_reader
-from prompts import context, code_parser_template
+from prompts import code_answer_context, candidate_variations, code_parser_template, single_code_template
 from model_evaluator import ModelEvaluator
+from semantic_cache import SemanticCache, ExactCache
 
-# Global LLM instances
-_chat_llm = None
-_code_llm = None
+# Reference documents and the on-disk cache of their vector index, one subdirectory per data fingerprint
+DATA_DIR = "./data"
+INDEX_CACHE_DIR = "./.index_cache"
+# Seconds after which a temporary index directory is considered left behind by a build that died
+INDEX_TEMP_MAX_AGE = 3600
+# Maximum number of PDFs parsed by LlamaCloud at the same time
+MAX_PARSE_WORKERS = 8
+# Documents parsed from each PDF, opened on first use
+PARSE_CACHE_DIR = "./.parse_cache"
+_parse_cache = None
+_parse_cache_lock = threading.Lock()
 
-def get_llm(model_name: str = "mistral") -> Ollama:
-    """Get or create an LLM instance."""
-    global _chat_llm, _code_llm
-    
-    if model_name == "codellama":
-        if _code_llm is None:
-            _code_llm = Ollama(model=model_name, request_timeout=300)
-        return _code_llm
-    else:
-        if _chat_llm is None:
-            _chat_llm = Ollama(model=model_name, request_timeout=300)
-        return _chat_llm
+# Created once per process, so uploads and the index loader can rely on it
+os.makedirs(DATA_DIR, exist_ok=True)
+
+load_dotenv()   # load the .env file for api key, once per process
+
+# Number of generations fired concurrently for each prompt
+PARALLEL_ATTEMPTS = 3
+# Seconds a prompt's generation attempts may run before they are abandoned
+GENERATION_TIMEOUT = 180
+
+# Worker threads running generation attempts, created on first use
+_generation_pool = None
+_generation_pool_lock = threading.Lock()
+
+# Consecutive timed out generations after which new ones fail fast, and for how many seconds
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
+
+# Prompts up to this length that mention none of these words, no filename and no reference file
+# are first answered by the code model alone, without the agent
+SIMPLE_PROMPT_MAX_LENGTH = 200
+_AGENT_PROMPT_WORDS = re.compile(r"\b(explain|why|design|compare|analy[sz]e|read|file|upload|document|reference|pdf)",
+                                 re.IGNORECASE)
+_FILENAME_TOKEN = re.compile(r"\b\w+\.\w{1,5}\b")
+
+# Minimum number of new characters streamed before the partial code preview is refreshed
+PREVIEW_STEP = 200
+# Seconds between two refreshes of the partial code preview
+PREVIEW_INTERVAL = 0.25
+
+# Outcome of a generation attempt: the response text, its code output (None if it isn't a complete one),
+# and Ollama's prompt_eval_count and eval_count for its formatting (None if it wasn't formatted)
+AttemptOutcome = Tuple[str, Optional[Any], Optional[Tuple[int, int]]]
+
+# Longest prefix of a JSON string body made only of complete characters and escape sequences
+_JSON_STRING_PREFIX = re.compile(r'(?:[^"\\]|\\u[0-9a-fA-F]{4}|\\[^u])*')
+
+# Embedding model of the reference documents index, and whether to run it in fp16/int8 instead of fp32
+EMBED_MODEL = "local:BAAI/bge-m3"
+EMBED_REDUCED_PRECISION = True
+
+
+class CodeOutput(BaseModel):
+    code: str
+    description: str
+    filename: str
+
+
+# Prompt asking the LLM to format an agent answer as a CodeOutput, built once at import.
+# The agent answer comes last, so every formatting call starts with the same instructions and schema
+# and Ollama can reuse their prefilled KV cache.
+_PARSER = PydanticOutputParser(CodeOutput)
+_JSON_PROMPT = PromptTemplate(_PARSER.format(code_parser_template) + "\n\nHere is the response: {response}")
+
+# Global LLM instances, one per model name and num_keep; the lock keeps concurrent sessions from building duplicates
+_llms: Dict[Tuple[str, Optional[int]], Ollama] = {}
+_llms_lock = threading.Lock()
+
+# How long Ollama keeps a model loaded after a request made through query_llm/stream_llm
+LLM_KEEP_ALIVE = "30m"
+# Number of leading prompt tokens Ollama keeps when it shifts a full context, set on formatting requests only:
+# the tokenized length of the static formatting prompt, _JSON_PROMPT with an empty response. Measured as 173
+# (BOS, [INST] and 171 prompt tokens) with mistral's v3 tokenizer and Ollama's mistral template; other chat models
+# tokenize it to a few more or fewer tokens. Re-measure when code_parser_template or CodeOutput changes
+FORMAT_NUM_KEEP = 173
+
+# Semantic caches of generated code outputs, one .npz file per model pair
+PROMPT_CACHE_DIR = "logs/prompt_cache"
+# Model pairs whose agents and response caches are kept in memory; those of a replaced data fingerprint are evicted
+CACHED_MODEL_PAIRS = 8
+
+# Data fingerprint the cached agents were built for
+_agents_fingerprint = None
+_agents_lock = threading.Lock()
+
+# Persistent cache of query_llm results, opened on first use
+LLM_CACHE_DIR = "logs/llm_cache"
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
 
-def query_llm(prompt: str, model: str = "mistral") -> Union[str, Dict[str, Any], List[str]]:
+def _get_llm_cache() -> diskcache.Cache:
+    """Get or open the on-disk LLM response cache."""
+    global _llm_cache
+
+    if _llm_cache is None:
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                _llm_cache = diskcache.Cache(LLM_CACHE_DIR)
+    return _llm_cache
+
+def get_llm(model_name: str = "mistral", num_keep: Optional[int] = None) -> Ollama:
+    """
+    Get or create the LLM instance for a model.
+    Args: model_name: Name of the Ollama model
+          num_keep: Leading prompt tokens kept when a full context is shifted (None for Ollama's default)
+    """
+    key = (model_name, num_keep)
+    if key not in _llms:
+        with _llms_lock:
+            if key not in _llms:
+                _llms[key] = Ollama(model=model_name, request_timeout=300,
+                                    additional_kwargs={} if num_keep is None else {"num_keep": num_keep})
+    return _llms[key]
+
+@lru_cache(maxsize=None)
+def get_embed_model(model_name: str = EMBED_MODEL):
+    """
+    Get or load an embedding model, shared by every index build in the process.
+    The weights are reduced to fp16 on a GPU, or to dynamically quantized int8 linear layers on a CPU,
+    which roughly halves the memory footprint and speeds up embedding with near-identical retrieval quality.
+    """
+    embed_model = resolve_embed_model(model_name)
+    if EMBED_REDUCED_PRECISION and isinstance(getattr(embed_model, "_model", None), torch.nn.Module):
+        if torch.cuda.is_available():
+            embed_model._model.half()
+        else:
+            torch.quantization.quantize_dynamic(embed_model._model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return embed_model
+
+def query_llm(prompt: str, model: str = "mistral", response_format: Optional[str] = None,
+              cache: bool = True) -> Union[str, Dict[str, Any], List[str]]:
     """
     Centralized function to query the LLM.    
     Args: prompt: The prompt to send to the LLM
           model: The model to use (default: "mistral")
+          response_format: Expected JSON shape, "json" for an object or "json_array" for a list
+          cache: Reuse/store the parsed response in the on-disk cache keyed by (model, format, prompt)
     Returns: Union[str, Dict, List]: The LLM's response in the specified format
     """
+    if not cache:
+        return _query_llm_uncached(prompt, model, response_format)
+
+    key = _cache_key(prompt, model, response_format)
+    llm_cache = _get_llm_cache()
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = _query_llm_uncached(prompt, model, response_format)
+    # Errors are returned as strings and are never worth replaying
+    if not isinstance(result, str):
+        llm_cache.set(key, result)
+    return result
+
+def _cache_key(prompt: str, model: str, response_format: Optional[str]) -> str:
+    """Key of a response in the on-disk LLM cache."""
+    return hashlib.sha256(f"{model}|{response_format}|{prompt}".encode()).hexdigest()
+
+def _query_llm_uncached(prompt: str, model: str,
+                        response_format: Optional[str]) -> Union[str, Dict[str, Any], List[str]]:
+    """Send the prompt to the LLM and parse its JSON response."""
     llm = get_llm(model)
     
     try:
-        result = llm.complete(prompt)
-        return json.loads(result.text)
+        text = llm.complete(prompt, **_request_kwargs(response_format)).text
     except Exception as e:
         return f"Error: {str(e)}"
+    return parse_llm_json(text, response_format)
 
-# Function to initialize the AI components
-@st.cache_resource
-def initialize_ai_components(chat_model: str = "mistral", code_model: str = "codellama"):
-    load_dotenv()   # load the .env file for api key
+def _request_kwargs(response_format: Optional[str]) -> Dict[str, Any]:
+    """
+    Top-level Ollama request arguments: keep the model loaded between calls, and constrain the response to valid JSON.
+    Ollama's JSON mode always produces an object, so arrays are requested wrapped in one.
+    """
+    kwargs = {"keep_alive": LLM_KEEP_ALIVE}
+    if response_format in ("json", "json_array"):
+        kwargs["format"] = "json"
+    return kwargs
 
-    llm = Ollama(model = chat_model, request_timeout = 300)
-    code_llm = Ollama(model = code_model, request_timeout = 300)
+def parse_llm_json(text: str, response_format: Optional[str] = None) -> Union[str, Dict[str, Any], List[str]]:
+    """
+    Parse the JSON returned by the LLM.
+    Args: text: Raw LLM response
+          response_format: Expected JSON shape, "json" for an object or "json_array" for a list
+    Returns: Union[str, Dict, List]: The parsed response, or an error string if it isn't valid JSON
+    """
+    try:
+        result = orjson.loads(text)
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+    # Models often wrap a requested array in an object, e.g. {"results": [...]}
+    if response_format == "json_array" and isinstance(result, dict):
+        lists = [value for value in result.values() if isinstance(value, list)]
+        if len(lists) == 1:
+            return lists[0]
+    return result
+
+def stream_llm(prompt: str, model: str = "mistral", response_format: Optional[str] = None,
+               cache: bool = True) -> Iterator[str]:
+    """
+    Stream the LLM's response text as it is generated.
+    A cached response is yielded in one piece; a fresh one is parsed and cached once the stream ends.
+    Args: prompt: The prompt to send to the LLM
+          model: The model to use (default: "mistral")
+          response_format: Expected JSON shape, "json" for an object or "json_array" for a list
+          cache: Reuse/store the parsed response in the on-disk cache shared with query_llm
+    Returns: Iterator[str]: Chunks of the response text
+    """
+    key = _cache_key(prompt, model, response_format)
+    if cache:
+        cached = _get_llm_cache().get(key)
+        if cached is not None:
+            yield orjson.dumps(cached).decode()
+            return
+
+    chunks = []
+    for response in get_llm(model).stream_complete(prompt, **_request_kwargs(response_format)):
+        chunks.append(response.delta)
+        yield response.delta
+
+    if cache:
+        result = parse_llm_json("".join(chunks), response_format)
+        if not isinstance(result, str):
+            _get_llm_cache().set(key, result)
+
+def _as_code_output(item: Any) -> Optional[Dict[str, Any]]:
+    """Keep the code output fields of an LLM result, or None if any of them is missing."""
+    if not isinstance(item, dict) or not all(isinstance(item.get(key), str) for key in ("code", "description", "filename")):
+        return None
+    return {key: item[key] for key in ("code", "description", "filename")}
+
+def classify_prompt(prompt: str, file_names: Iterable[str] = ()) -> str:
+    """
+    Classify a prompt as "simple", a short self-contained code request the code model can answer alone,
+    or "agent", when it needs the agent's reasoning or its tools over the uploaded files.
+    A prompt naming a file, e.g. "use test.py", always goes to the agent: the code model alone would make up its contents.
+    Args: prompt: The user prompt
+          file_names: Names of the uploaded files, in addition to those in the data directory
+    """
+    if len(prompt) > SIMPLE_PROMPT_MAX_LENGTH or _AGENT_PROMPT_WORDS.search(prompt) or _FILENAME_TOKEN.search(prompt):
+        return "agent"
+    words = set(re.findall(r"[\w.-]+", prompt.lower()))
+    for name in {*os.listdir(DATA_DIR), *file_names}:
+        name = name.lower()
+        if name in words or os.path.splitext(name)[0] in words:
+            return "agent"
+    return "simple"
+
+def generate_code_directly(prompt: str, code_model: str = "codellama") -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Generate code with a single JSON-mode completion of the code model, skipping the agent's reasoning and tool calls.
+    The response isn't stored in the on-disk LLM cache; only the one run_generation accepts is cached.
+    Returns: Tuple[str, Dict]: The response text and its code output (None if the response isn't one)
+    """
+    result = query_llm(single_code_template.format(prompt=prompt), code_model, response_format="json", cache=False)
+    code_output = _as_code_output(result)
+    return (orjson.dumps(code_output).decode() if code_output is not None else str(result)), code_output
+
+async def query_llm_async(prompt: str, model: str = "mistral", response_format: Optional[str] = None,
+                          cache: bool = True) -> Union[str, Dict[str, Any], List[str]]:
+    """
+    Awaitable variant of query_llm so several prompts can be in flight at once.
+    The Ollama client blocks on its HTTP call, so the request is run in a worker thread.
+    """
+    return await asyncio.to_thread(query_llm, prompt, model, response_format, cache)
 
-    parser = LlamaParse(api_key = os.getenv("LLAMACLOUD_API_KEY"), result_type="markdown")
-    documents = SimpleDirectoryReader("./data", file_extractor={".pdf": parser}).load_data()
-    embed_model = resolve_embed_model("local:BAAI/bge-m3")
+def data_fingerprint(data_dir: str = DATA_DIR) -> str:
+    """Hash of the path, size and modification time of every file in the data directory."""
+    files = sorted((str(path), path.stat().st_mtime_ns, path.stat().st_size)
+                   for path in Path(data_dir).rglob("*") if path.is_file())
+    return hashlib.sha256(repr(files).encode()).hexdigest()
+
+def _get_parse_cache() -> diskcache.Cache:
+    """Get or open the on-disk cache of parsed PDFs."""
+    global _parse_cache
+
+    if _parse_cache is None:
+        with _parse_cache_lock:
+            if _parse_cache is None:
+                _parse_cache = diskcache.Cache(PARSE_CACHE_DIR)
+    return _parse_cache
+
+def _parse_key(path: str) -> str:
+    """Key of a file's parsed documents: its path, size and modification time, so a changed file is parsed again."""
+    stat = os.stat(path)
+    return f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def _load_documents(data_dir: str = DATA_DIR) -> List[Document]:
+    """
+    Load the documents in the data directory.
+    PDFs are parsed by LlamaParse concurrently, since each parse is a slow HTTP round-trip to LlamaCloud,
+    and only when they are new or changed: the parsed documents are cached on disk.
+    """
+    files = [path for path in sorted(Path(data_dir).iterdir()) if path.is_file() and not path.name.startswith(".")]
+    pdf_paths = [str(path) for path in files if path.suffix.lower() == ".pdf"]
+    other_paths = [str(path) for path in files if path.suffix.lower() != ".pdf"]
+
+    documents = []
+    if pdf_paths:
+        parse_cache = _get_parse_cache()
+        keys = {path: _parse_key(path) for path in pdf_paths}
+        parsed = {path: parse_cache.get(keys[path]) for path in pdf_paths}
+        to_parse = [path for path in pdf_paths if parsed[path] is None]
+        if to_parse:
+            parser = LlamaParse(api_key = os.getenv("LLAMACLOUD_API_KEY"), result_type="markdown")
+            with ThreadPoolExecutor(max_workers=min(MAX_PARSE_WORKERS, len(to_parse))) as pool:
+                for path, path_documents in zip(to_parse, pool.map(parser.load_data, to_parse)):
+                    parsed[path] = path_documents
+                    # A failed parse returns no documents, and is retried by the next build
+                    if path_documents:
+                        parse_cache.set(keys[path], path_documents)
+        for path in pdf_paths:
+            documents.extend(parsed[path])
+    if other_paths:
+        documents.extend(SimpleDirectoryReader(input_files=other_paths).load_data())
+    return documents
+
+def _load_or_build_index(embed_model, fingerprint: str) -> VectorStoreIndex:
+    """
+    Load the vector index persisted for the current contents of the data directory,
+    or parse and embed the documents and persist the new index, removing the ones of previous contents.
+    """
+    persist_dir = os.path.join(INDEX_CACHE_DIR, fingerprint)
+    if os.path.exists(persist_dir):
+        try:
+            storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+            return load_index_from_storage(storage_context, embed_model=embed_model)
+        except Exception as e:
+            print(f"Error loading the persisted index, rebuilding it: {e}")
+            shutil.rmtree(persist_dir, ignore_errors=True)
+
+    documents = _load_documents()
     vector_index = VectorStoreIndex.from_documents(documents, embed_model= embed_model)
-    query_engine = vector_index.as_query_engine(llm=llm)
+    temp_dir = None
+    try:
+        # Persisted to a temporary directory that is moved into place once complete,
+        # so a process dying mid-persist never leaves a partial index to load
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=f".{fingerprint}-", dir=INDEX_CACHE_DIR)
+        vector_index.storage_context.persist(persist_dir=temp_dir)
+        os.replace(temp_dir, persist_dir)
+    except Exception as e:
+        # Another process may have persisted the same index first
+        print(f"Error persisting the index: {e}")
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    _prune_index_cache(fingerprint)
+    return vector_index
+
+def _prune_index_cache(fingerprint: str):
+    """
+    Remove the persisted indexes of previous data directory contents, and the temporary directories
+    left by builds that died more than INDEX_TEMP_MAX_AGE seconds ago.
+    """
+    for entry in os.scandir(INDEX_CACHE_DIR):
+        if entry.name == fingerprint or not entry.is_dir():
+            continue
+        if entry.name.startswith(".") and time.time() - entry.stat().st_mtime < INDEX_TEMP_MAX_AGE:
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+@st.cache_resource(max_entries=CACHED_MODEL_PAIRS)
+def get_prompt_cache(chat_model: str, code_model: str, fingerprint: str) -> SemanticCache:
+    """
+    Semantic cache mapping prompts to the code outputs generated by a model pair, shared by every session.
+    Outputs may be built on the reference files, so the cache starts empty when the data fingerprint changes.
+    """
+    name = re.sub(r"[^\w.-]", "_", f"{chat_model}__{code_model}")
+    return SemanticCache(os.path.join(PROMPT_CACHE_DIR, f"{name}.npz"), version=fingerprint)
+
+@st.cache_resource(max_entries=CACHED_MODEL_PAIRS)
+def get_response_cache(chat_model: str, code_model: str, fingerprint: str) -> ExactCache:
+    """
+    Exact-match cache mapping prompts to the code outputs generated by a model pair, shared by every session.
+    Like the prompt cache, a new one is used when the data fingerprint changes; the arguments are only its key.
+    """
+    return ExactCache()
+
+# Function to initialize the AI components
+def initialize_ai_components(chat_model: str = "mistral", code_model: str = "codellama",
+                             fingerprint: Optional[str] = None):
+    """
+    Get the agent factory, output formatter and evaluator for a model pair.
+    Safe to call on every Streamlit rerun: the index and the per-model components are st.cache_resource
+    singletons shared by all sessions, rebuilt only when the models or the data directory change.
+    Only the data fingerprint is recomputed per call, so uploaded files are picked up,
+    unless the caller passes the one it computed (see data_fingerprint).
+    After replacing a model's weights under the same name, call _build_agent.clear() to pick them up.
+    """
+    global _agents_fingerprint
+
+    # The index only depends on the data, so swapping models reuses it instead of re-embedding the documents
+    fingerprint = fingerprint or data_fingerprint()
+    with _agents_lock:
+        if fingerprint != _agents_fingerprint:
+            # The agents of the previous data hold its index; drop them so it can be freed
+            _build_agent.clear()
+            _agents_fingerprint = fingerprint
+    return _build_agent(chat_model, code_model, fingerprint, _build_index(fingerprint))
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _build_index(fingerprint: str) -> VectorStoreIndex:
+    """Vector index of the data directory, cached until the data fingerprint changes; only the latest one is kept."""
+    return _load_or_build_index(get_embed_model(), fingerprint)
+
+@st.cache_resource(max_entries=CACHED_MODEL_PAIRS)
+def _build_agent(chat_model: str, code_model: str, fingerprint: str, _index: VectorStoreIndex):
+    """Agent factory, output formatter and evaluator for a model pair, over the index built for the fingerprint."""
+    llm = get_llm(chat_model)
+    code_llm = get_llm(code_model)
+
+    query_engine = _index.as_query_engine(llm=llm)
 
     tools = [QueryEngineTool(query_engine = query_engine,
                              metadata = ToolMetadata(name = "documentation_reader",
@@ -71,21 +456,360 @@ def initialize_ai_components(chat_model: str = "mistral", code_model: str = "cod
                                                                   "or analyzing uploaded files.")),
              code_reader]
 
-    agent = ReActAgent.from_tools(tools,
-                                  llm=code_llm,
-                                  verbose=False,
-                                  context=context)
+    # Agents keep per-query state, so concurrent generations each get their own instance
+    new_agent = partial(ReActAgent.from_tools, tools, llm=code_llm, verbose=False, context=code_answer_context)
 
-    class CodeOutput(BaseModel):
-        code: str
-        description: str
-        filename: str
+    model_evaluator = ModelEvaluator()
+    # Only formatting prompts share a static prefix worth keeping; the agent's chats don't
+    output_formatter = partial(format_code_output, get_llm(chat_model, num_keep=FORMAT_NUM_KEEP), _JSON_PROMPT)
 
-    parser = PydanticOutputParser(CodeOutput)
-    json_prompt_template = PromptTemplate(parser.format(code_parser_template))
-    output_pipeline = QueryPipeline(chain = [json_prompt_template, llm])
+    return new_agent, output_formatter, model_evaluator
 
-    model_evaluator = ModelEvaluator()
 
-    return agent, output_pipeline, model_evaluator
+def partial_json_string(text: str, field: str = "code") -> Optional[str]:
+    """
+    Decode the value of a string field from JSON that may still be incomplete.
+    Args: text: JSON text streamed so far
+          field: Name of the string field
+    Returns: Optional[str]: The part of the value received so far, or None if the value hasn't started
+    """
+    start = re.search(rf'"{re.escape(field)}"\s*:\s*"', text)
+    if start is None:
+        return None
+    body = _JSON_STRING_PREFIX.match(text, start.end()).group()
+    try:
+        return orjson.loads(f'"{body}"')
+    except orjson.JSONDecodeError:
+        return None
+
+def format_code_output(llm: Ollama, json_prompt_template: PromptTemplate, response: Any,
+                       on_partial: Optional[Callable[[str], None]] = None,
+                       stop: Optional[threading.Event] = None) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """
+    Stream the LLM's JSON formatting of an agent answer, decoded in Ollama's JSON mode.
+    Generation stops as soon as the response can't be a JSON object, so a malformed answer doesn't cost a full completion.
+    Args: llm: LLM formatting the answer
+          json_prompt_template: Prompt asking for the code output JSON
+          response: The agent's answer
+          on_partial: Called from the streaming thread with the code received so far
+          stop: When set, the generation is abandoned and the text received so far is returned
+    Returns: Tuple[str, Tuple[int, int]]: The raw formatted response text, and Ollama's prompt_eval_count and
+             eval_count (None unless the generation completed). The counts are returned rather than recorded here,
+             since this runs on the attempts' worker threads and only the winning attempt's counts are recorded
+    """
+    chunks = []
+    usage = None
+    length = previewed = 0
+    checked = False
+    stream = llm.stream_complete(json_prompt_template.format(response=response), **_request_kwargs("json"))
+    try:
+        for chunk in stream:
+            if stop is not None and stop.is_set():
+                break
+            chunks.append(chunk.delta)
+            length += len(chunk.delta)
+            if isinstance(chunk.raw, dict) and chunk.raw.get("done"):
+                usage = (chunk.raw.get("prompt_eval_count", 0), chunk.raw.get("eval_count", 0))
+            if not checked:
+                head = "".join(chunks).lstrip().removeprefix("assistant:").lstrip()
+                if head:
+                    if head[0] != "{":
+                        break
+                    checked = True
+            if on_partial is not None and length - previewed >= PREVIEW_STEP:
+                previewed = length
+                code = partial_json_string("".join(chunks))
+                if code:
+                    on_partial(code)
+    finally:
+        # Closing the generator closes the HTTP response, so an abandoned generation stops on the server
+        stream.close()
+    return "".join(chunks), usage
+
+def _get_generation_pool() -> ThreadPoolExecutor:
+    """
+    Get the worker pool running generation attempts.
+    Unlike asyncio's default executor, asyncio.run doesn't wait for it on exit,
+    so abandoned attempts finish in the background instead of delaying the response.
+    """
+    global _generation_pool
+
+    if _generation_pool is None:
+        with _generation_pool_lock:
+            if _generation_pool is None:
+                _generation_pool = ThreadPoolExecutor(max_workers=4 * PARALLEL_ATTEMPTS,
+                                                      thread_name_prefix="generation")
+    return _generation_pool
+
+def run_generation_attempt(agent: ReActAgent, output_formatter: Callable[..., str], prompt: str,
+                           on_partial: Optional[Callable[[str], None]] = None,
+                           stop: Optional[threading.Event] = None) -> AttemptOutcome:
+    """
+    Run one code generation: the agent answers the prompt with a code output JSON object.
+    Only an answer that isn't one is sent to the output formatter, which costs a second LLM call.
+    Args: agent: Agent answering the prompt
+          output_formatter: Streams the agent's answer formatted as JSON (see format_code_output)
+          prompt: The user prompt
+          on_partial: Called with the code received so far, while the answer streams and while it is formatted
+          stop: When set, the attempt is abandoned as soon as possible
+    Returns: AttemptOutcome: The formatted response text, its code output and the formatting's token counts
+    """
+    answer = _stream_answer(agent, prompt, on_partial, stop)
+    # Once stopped, generate_code has already returned and discards this outcome
+    if stop is not None and stop.is_set():
+        return answer, None, None
+    return finish_generation(answer, output_formatter, on_partial, stop)
+
+def _stream_answer(agent: ReActAgent, prompt: str, on_partial: Optional[Callable[[str], None]] = None,
+                   stop: Optional[threading.Event] = None) -> str:
+    """
+    Collect the agent's final answer as it streams, reporting the code it contains so far,
+    so the preview starts with the answer rather than after it.
+    Returns: str: The full answer, or the part received before stop was set
+    """
+    chunks = []
+    length = previewed = 0
+    for delta in agent.stream_chat(prompt).response_gen:
+        if stop is not None and stop.is_set():
+            break
+        chunks.append(delta)
+        length += len(delta)
+        if on_partial is not None and length - previewed >= PREVIEW_STEP:
+            previewed = length
+            code = partial_json_string("".join(chunks))
+            if code:
+                on_partial(code)
+    return "".join(chunks)
+
+def start_stream_generation(agent: ReActAgent, prompt: str) -> Future:
+    """
+    Start the agent's answer to the prompt on the generation pool. The agent reasons before its answer
+    starts streaming, so starting early, e.g. while the previous failure is displayed, saves that wait.
+    Pass the future to stream_generation.
+    """
+    return _get_generation_pool().submit(agent.stream_chat, prompt)
+
+def stream_generation(started: Future, timeout: Optional[float] = GENERATION_TIMEOUT) -> Iterator[str]:
+    """
+    Stream an agent's final answer started by start_stream_generation as it is generated, e.g. into st.write_stream.
+    Pass the full answer to finish_generation to get the code output.
+    Raises: TimeoutError once the answer took longer than timeout seconds (None to wait indefinitely)
+    """
+    begun = time.perf_counter()
+    try:
+        response = started.result(timeout=timeout)
+    except FutureTimeoutError:
+        raise TimeoutError(f"The answer didn't start within {timeout} seconds.") from None
+    for delta in response.response_gen:
+        if timeout is not None and time.perf_counter() - begun > timeout:
+            raise TimeoutError(f"The answer didn't finish within {timeout} seconds.")
+        yield delta
+
+def finish_generation(answer: str, output_formatter: Callable[..., str],
+                      on_partial: Optional[Callable[[str], None]] = None,
+                      stop: Optional[threading.Event] = None) -> AttemptOutcome:
+    """
+    Turn an agent answer into the code output JSON, formatting it with a second LLM call only if it isn't one already.
+    Args: answer: The agent's answer
+          output_formatter: Streams the agent's answer formatted as JSON (see format_code_output)
+          on_partial: Called with the code received so far while the answer is formatted
+          stop: When set, the formatting is abandoned as soon as possible
+    Returns: AttemptOutcome: The formatted response text, its code output (None if it isn't a complete one)
+             and the formatting's token counts
+    """
+    answer, parsed = _clean_and_parse(answer)
+    code_output = _as_code_output(parsed)
+    if code_output is not None:
+        return answer, code_output, None
+    formatted, usage = output_formatter(answer, on_partial=on_partial, stop=stop)
+    formatted, parsed = _clean_and_parse(formatted)
+    return formatted, _as_code_output(parsed), usage
+
+def _clean_and_parse(raw: str) -> Tuple[str, Optional[Any]]:
+    """
+    Strip the chat role prefix from an LLM response and parse it as JSON, repairing a nearly valid code output.
+    Returns: Tuple[str, Any]: The cleaned text and its parsed JSON (None if it isn't and can't be repaired),
+             a fresh object on every call since callers cache and store it
+    """
+    text, json_text = _clean_json(raw)
+    return text, (None if json_text is None else orjson.loads(json_text))
+
+@lru_cache(maxsize=128)
+def _clean_json(raw: str) -> Tuple[str, Optional[Union[str, bytes]]]:
+    """
+    Strip the chat role prefix from an LLM response and find valid JSON for it.
+    Memoized, since retries and speculative attempts often return the same text.
+    Returns: Tuple[str, Union[str, bytes]]: The cleaned text and its valid or repaired JSON (None if there is none)
+    """
+    text = raw.strip().removeprefix("assistant:").lstrip()
+    try:
+        orjson.loads(text)
+        return text, text
+    except orjson.JSONDecodeError:
+        repaired = _repair_json(text)
+        return text, (None if repaired is None else orjson.dumps(repaired))
+
+def _repair_json(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Recover the code output of a nearly valid response, so it doesn't cost another LLM call:
+    the outermost {...} block is kept, dropping surrounding prose and code fences,
+    and parsed leniently (trailing commas, single quotes, unquoted keys...).
+    Returns: Optional[Dict]: The code output, or None if there is no complete one to recover
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    block = text[start:end + 1]
+    try:
+        repaired = orjson.loads(block)
+    except orjson.JSONDecodeError:
+        try:
+            repaired = dirtyjson.loads(block)
+        except Exception:
+            return None
+    # Anything short of a complete code output would be rejected and retried anyway;
+    # _as_code_output also copies the fields out of dirtyjson's position-tracking dict
+    return _as_code_output(repaired)
+
+class CircuitOpenError(TimeoutError):
+    """Raised instead of starting a generation while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """
+    Fails generations fast after repeated timeouts, so a stalled Ollama server doesn't
+    keep every session waiting for the full timeout. Shared by all sessions of the process.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        """
+        Initialize the CircuitBreaker.
+
+        Args:
+            threshold: Consecutive timeouts after which the breaker opens
+            cooldown: Seconds the breaker stays open before a generation is tried again
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._timeouts = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """Seconds the breaker stays open, 0 if it is closed."""
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def check(self):
+        """Raise CircuitOpenError while the breaker is open."""
+        remaining = self.remaining()
+        if remaining > 0:
+            raise CircuitOpenError(f"The LLM server keeps timing out; generation is paused for {remaining:.0f} more seconds.")
+
+    def record_success(self):
+        """A generation finished in time."""
+        with self._lock:
+            self._timeouts = 0
+
+    def record_timeout(self):
+        """A generation timed out; opens the breaker after threshold consecutive ones."""
+        with self._lock:
+            self._timeouts += 1
+            if self._timeouts >= self.threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                self._timeouts = 0
+
+# Breaker guarding every generation of the process
+generation_breaker = CircuitBreaker()
+
+@dataclass
+class GenerationAttempts:
+    """Speculative generation attempts running on the generation pool (see submit_generation_attempts)."""
+    futures: List[Future]
+    partials: Dict[int, str]  # code streamed so far by each attempt
+    stop: threading.Event  # worker threads can't be cancelled, so abandoned attempts watch it and stop streaming
+
+    def cancel(self):
+        """Abandon the attempts that are still running."""
+        self.stop.set()
+        for future in self.futures:
+            future.cancel()
+
+def submit_generation_attempts(agent_factory: Callable[[], ReActAgent], output_formatter: Callable[..., str],
+                               prompt: str, attempts: int = PARALLEL_ATTEMPTS) -> GenerationAttempts:
+    """
+    Start speculative generation attempts for the prompt on the generation pool, each with its own agent
+    and with one of the candidate_variations appended, so they don't all converge on the same answer.
+    Await them with generate_code; submitting them beforehand, e.g. while the previous failure is displayed,
+    gets them going sooner.
+    """
+    partials: Dict[int, str] = {}
+    stop = threading.Event()
+    pool = _get_generation_pool()
+    futures = [pool.submit(run_generation_attempt, agent_factory(),
+                           output_formatter, prompt + candidate_variations[i % len(candidate_variations)],
+                           partial(partials.__setitem__, i), stop)
+               for i in range(attempts)]
+    return GenerationAttempts(futures, partials, stop)
+
+async def generate_code(agent_factory: Callable[[], ReActAgent], output_formatter: Callable[..., str], prompt: str,
+                        attempts: int = PARALLEL_ATTEMPTS,
+                        on_partial: Optional[Callable[[str], None]] = None,
+                        timeout: Optional[float] = GENERATION_TIMEOUT,
+                        submitted: Optional[GenerationAttempts] = None) -> AttemptOutcome:
+    """
+    Run several speculative generation attempts for the prompt concurrently (see submit_generation_attempts).
+    The first attempt with a complete code output wins and the others are abandoned.
+    Ollama serves them in parallel up to OLLAMA_NUM_PARALLEL requests per model.
+    Args: agent_factory: Callable creating a fresh agent
+          output_formatter: Streams the agent's answer formatted as JSON (see format_code_output)
+          prompt: The user prompt
+          attempts: Number of concurrent attempts
+          on_partial: Called on the event loop's thread with the longest code streamed so far by any attempt
+          timeout: Seconds after which the attempts still running are abandoned (None to wait indefinitely)
+          submitted: Attempts already started for the prompt by submit_generation_attempts
+    Returns: AttemptOutcome: The first attempt with a complete code output, otherwise the first completed attempt
+    Raises: TimeoutError if no attempt completed in time,
+            otherwise the first failed attempt's exception if every attempt failed
+    """
+    if submitted is None:
+        submitted = submit_generation_attempts(agent_factory, output_formatter, prompt, attempts)
+    partials = submitted.partials
+    loop = asyncio.get_running_loop()
+    pending = {asyncio.wrap_future(future) for future in submitted.futures}
+
+    completed = []
+    errors = []
+    shown = ""
+    deadline = None if timeout is None else loop.time() + timeout
+    try:
+        while pending:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            wait = PREVIEW_INTERVAL if on_partial else None
+            if remaining is not None:
+                wait = remaining if wait is None else min(wait, remaining)
+            done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                outcome = task.result()
+                if _as_code_output(outcome[1]) is not None:
+                    return outcome
+                # Incomplete; kept in case no attempt does better
+                completed.append(outcome)
+
+            # Attempts stream from worker threads; the preview is refreshed from here so UI callbacks stay on the caller's thread
+            longest = max(partials.values(), key=len, default="")
+            if on_partial is not None and len(longest) > len(shown):
+                shown = longest
+                on_partial(shown)
+    finally:
+        submitted.cancel()
 
+    if completed:
+        return completed[0]
+    if pending:
+        raise TimeoutError(f"No generation attempt finished within {timeout} seconds.")
+    raise errors[0]
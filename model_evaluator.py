@@ -1,28 +1,71 @@
+import io
 import time
-import json
+import orjson
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Any, Optional
-import pandas as pd
-import streamlit as st
-import matplotlib.pyplot as plt
+from typing import Dict, List, Any, Optional, TYPE_CHECKING
 from pathlib import Path
 
+# Streamlit, pandas and matplotlib are only needed by the dashboard, so plain evaluation logging does not pay for them
+try:
+    import streamlit as st
+except ImportError:
+    st = None
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+EVALUATION_LOG_PATH = "logs/model_evaluations.jsonl"
+
+# Worker writing evaluations to the log off the Streamlit script thread, created on first use.
+# A single worker keeps the log in recording order, so the lock keeps concurrent sessions from creating two
+_log_pool = None
+_log_pool_lock = threading.Lock()
+
+# Display labels of the metrics computed by ModelEvaluator._calculate_code_metrics
+_METRIC_LABELS = {
+    "total_lines": "Total Lines",
+    "non_empty_lines": "Non Empty Lines",
+    "character_count": "Character Count",
+    "has_docstrings": "Has Docstrings",
+    "has_comments": "Has Comments",
+    "avg_line_length": "Avg Line Length",
+}
+
+
+def _get_log_pool() -> ThreadPoolExecutor:
+    """Get the worker writing evaluations. Its pending writes still complete when the process exits."""
+    global _log_pool
+
+    if _log_pool is None:
+        with _log_pool_lock:
+            if _log_pool is None:
+                _log_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="evaluation-log")
+    return _log_pool
+
+
+def _cache_data(func):
+    """Memoize a dashboard helper with st.cache_data when Streamlit is available."""
+    return st.cache_data(show_spinner=False)(func) if st is not None else func
+
 
 class ModelEvaluator:
     """
     A class to evaluate and compare LLM model performance for code generation tasks.
     """
 
-    def __init__(self, log_path: str = "logs/model_evaluations.json"):
+    def __init__(self, log_path: str = EVALUATION_LOG_PATH):
         """
         Initialize the ModelEvaluator.
 
         Args:
-            log_path: Path to store evaluation logs
+            log_path: Path to store evaluation logs (JSON Lines, one evaluation per line)
         """
         self.log_path = log_path
         self._ensure_log_file_exists()
+        self._migrate_legacy_log()
         self.current_evaluation = {
             "timestamp": None,
             "chat_model": None,
@@ -30,6 +73,8 @@ class ModelEvaluator:
             "prompt": None,
             "completion_time": None,
             "tokens_generated": None,
+            "prompt_eval_count": None,
+            "eval_count": None,
             "retry_count": 0,
             "success": False,
             "error": None,
@@ -38,13 +83,34 @@ class ModelEvaluator:
 
     def _ensure_log_file_exists(self):
         """Ensure the log file and directory exist."""
-        log_dir = os.path.dirname(self.log_path)
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+        # Both steps are atomic, so concurrent sessions can't race between a check and the creation
+        Path(self.log_path).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            open(self.log_path, 'x').close()
+        except FileExistsError:
+            pass
 
-        if not os.path.exists(self.log_path):
-            with open(self.log_path, 'w') as f:
-                json.dump([], f)
+    def _migrate_legacy_log(self):
+        """
+        Convert the evaluations saved as a single JSON array in the .json log used before JSON Lines, once:
+        only into an empty log, and the old file is renamed to .json.migrated.
+        """
+        legacy_path = os.path.splitext(self.log_path)[0] + ".json"
+        if legacy_path == self.log_path or not os.path.exists(legacy_path) or os.path.getsize(self.log_path):
+            return
+        migrated_path = legacy_path + ".migrated"
+        try:
+            # Only one process can rename the file, so the entries aren't converted twice
+            os.rename(legacy_path, migrated_path)
+        except OSError:
+            return
+        try:
+            with open(migrated_path, 'rb') as f:
+                entries = orjson.loads(f.read())
+            with open(self.log_path, 'ab') as f:
+                f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in entries))
+        except Exception as e:
+            print(f"Error converting the evaluations log: {e}")
 
     def start_evaluation(self, chat_model: str, code_model: str, prompt: str):
         """
@@ -56,13 +122,15 @@ class ModelEvaluator:
             prompt: User prompt for code generation
         """
         self.current_evaluation = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(),  # serialized to ISO 8601 by orjson
             "chat_model": chat_model,
             "code_model": code_model,
             "prompt": prompt,
             "start_time": time.time(),
             "completion_time": None,
             "tokens_generated": None,
+            "prompt_eval_count": None,
+            "eval_count": None,
             "retry_count": 0,
             "success": False,
             "error": None,
@@ -76,36 +144,52 @@ class ModelEvaluator:
         self.current_evaluation["error"] = error
         return self
 
+    def record_token_usage(self, prompt_eval_count: int, eval_count: int):
+        """
+        Record the token counts reported by Ollama for the generation.
+        A low prompt_eval_count relative to the prompt length means the server reused its prefix KV cache.
+        """
+        self.current_evaluation["prompt_eval_count"] = prompt_eval_count
+        self.current_evaluation["eval_count"] = eval_count
+        return self
+
     def record_success(self, code_output: Dict[str, Any]):
         """
         Record a successful code generation.
         Args: - code_output: The generated code output dictionary
         """
-        self.current_evaluation["success"] = True
-        self.current_evaluation["completion_time"] = time.time() - self.current_evaluation.pop("start_time")
+        evaluation = self.current_evaluation
+        evaluation["success"] = True
+        evaluation["completion_time"] = time.time() - evaluation.pop("start_time")
 
-        # Calculate approximate tokens generated (rough estimate)
-        code_length = len(code_output.get("code", ""))
-        self.current_evaluation["tokens_generated"] = code_length // 4  # Rough approximation
+        # Use Ollama's token count when it was reported, otherwise a rough estimate
+        if evaluation.get("eval_count"):
+            evaluation["tokens_generated"] = evaluation["eval_count"]
+        else:
+            code_length = len(code_output.get("code", ""))
+            evaluation["tokens_generated"] = code_length // 4  # Rough approximation
 
-        # Calculate basic code metrics
-        self.current_evaluation["code_metrics"] = self._calculate_code_metrics(code_output.get("code", ""))
+        # The code metrics and the write happen in the background, so the result renders without waiting on them
+        _get_log_pool().submit(self._finish_success, evaluation, code_output.get("code", ""))
 
-        # Save the evaluation
-        self._save_evaluation()
+        return evaluation["completion_time"]
 
-        return self.current_evaluation["completion_time"]
+    def _finish_success(self, evaluation: Dict[str, Any], code: str):
+        """Calculate the code metrics of a successful evaluation and save it."""
+        evaluation["code_metrics"] = self._calculate_code_metrics(code)
+        self._save_evaluation(evaluation)
 
     def record_failure(self, error: str):
         """Record a final failure after all retries."""
-        self.current_evaluation["success"] = False
-        self.current_evaluation["completion_time"] = time.time() - self.current_evaluation.pop("start_time")
-        self.current_evaluation["error"] = error
+        evaluation = self.current_evaluation
+        evaluation["success"] = False
+        evaluation["completion_time"] = time.time() - evaluation.pop("start_time")
+        evaluation["error"] = error
 
-        # Save the evaluation
-        self._save_evaluation()
+        # Save the evaluation in the background
+        _get_log_pool().submit(self._save_evaluation, evaluation)
 
-        return self.current_evaluation["completion_time"]
+        return evaluation["completion_time"]
 
     def _calculate_code_metrics(self, code: str) -> Dict[str, Any]:
         """
@@ -113,55 +197,87 @@ class ModelEvaluator:
         Args: - code: The generated code string
         Returns: Dictionary with code metrics
         """
-        lines = code.split("\n")
-        non_empty_lines = [line for line in lines if line.strip()]
+        # Gather every line statistic in a single pass over the code
+        total_lines = non_empty_lines = non_empty_length = 0
+        has_comments = False
+        for line in code.split("\n"):
+            total_lines += 1
+            stripped = line.strip()
+            if stripped:
+                non_empty_lines += 1
+                non_empty_length += len(line)
+                if stripped[0] == "#":
+                    has_comments = True
 
         metrics = {
-            "total_lines": len(lines),
-            "non_empty_lines": len(non_empty_lines),
+            "total_lines": total_lines,
+            "non_empty_lines": non_empty_lines,
             "character_count": len(code),
             "has_docstrings": '"""' in code or "'''" in code,
-            "has_comments": any(line.strip().startswith("#") for line in lines),
-            "avg_line_length": sum(len(line) for line in non_empty_lines) / max(len(non_empty_lines), 1)
+            "has_comments": has_comments,
+            "avg_line_length": non_empty_length / max(non_empty_lines, 1)
         }
 
         return metrics
 
-    def _save_evaluation(self):
-        """Save the current evaluation to the log file."""
+    def _save_evaluation(self, evaluation: Optional[Dict[str, Any]] = None):
+        """Save an evaluation, by default the current one, to the log file."""
         try:
-            with open(self.log_path, 'r') as f:
-                evaluations = json.load(f)
-            evaluations.append(self.current_evaluation)
-            with open(self.log_path, 'w') as f:
-                json.dump(evaluations, f, indent=2)
+            # Append mode opens with O_APPEND, so a single write of one line is atomic across writers
+            with open(self.log_path, 'ab') as f:
+                f.write(orjson.dumps(evaluation if evaluation is not None else self.current_evaluation) + b"\n")
         except Exception as e:
             print(f"Error saving the evaluation: {e}")
 
     @classmethod
-    def load_evaluations(cls) -> List[Dict[str, Any]]:
-        """Load all saved evaluations."""
-        log_path = "logs/model_evaluations.json"
+    def load_evaluations(cls, log_path: str = EVALUATION_LOG_PATH) -> List[Dict[str, Any]]:
+        """Load all saved evaluations, reusing the parsed log until the file changes."""
         if not os.path.exists(log_path):
             return []
+        return _read_log(log_path, _log_mtime(log_path))
 
-        try:
-            with open(log_path, 'r') as f:
-                return json.load(f)
-        except Exception:
-            return []
+
+def _log_mtime(log_path: str) -> int:
+    """Modification time of the log in nanoseconds, used to invalidate the cached data when an evaluation is added."""
+    return os.stat(log_path).st_mtime_ns if os.path.exists(log_path) else 0
+
+
+@_cache_data
+def _read_log(log_path: str, mtime: int) -> List[Dict[str, Any]]:
+    """Parse the evaluation log; mtime is only part of the cache key."""
+    try:
+        with open(log_path, 'rb') as f:
+            return [orjson.loads(line) for line in f if line.strip()]
+    except Exception:
+        return []
+
+
+@_cache_data
+def _load_df(log_path: str, mtime: int) -> "pd.DataFrame":
+    """Load the evaluation log as a DataFrame, reusing it until the file changes."""
+    import pandas as pd
+
+    return pd.DataFrame(ModelEvaluator.load_evaluations(log_path))
+
+
+@_cache_data
+def _aggregate(log_path: str, mtime: int, model_col: str) -> "pd.DataFrame":
+    """Success rate ('success', in %) and average completion time ('time') per model, in a single groupby pass."""
+    aggregates = _load_df(log_path, mtime).groupby(model_col).agg(
+        success=("success", "mean"), time=("completion_time", "mean"))
+    aggregates["success"] *= 100
+    return aggregates
 
 
 def render_evaluation_dashboard():
     """Render the model evaluation dashboard in Streamlit."""
     st.header("Model Evaluation Dashboard")
-    evaluations = ModelEvaluator.load_evaluations()
-    if not evaluations:
+    mtime = _log_mtime(EVALUATION_LOG_PATH)
+    df = _load_df(EVALUATION_LOG_PATH, mtime)
+    if df.empty:
         st.info("No model evaluations have been recorded yet. Generate some code to see performance metrics!")
         return
 
-    # Convert to DataFrame for easier analysis
-    df = pd.DataFrame(evaluations)
     col1, col2 = st.columns(2)
     with col1:
         success_rate = df["success"].mean() * 100
@@ -172,22 +288,18 @@ def render_evaluation_dashboard():
 
     # Model comparison
     st.subheader("Model Performance Comparison")
-    # Get unique models
-    chat_models = df["chat_model"].unique()
-    code_models = df["code_model"].unique()
-
     # Create a tab for each type of model
     tab1, tab2 = st.tabs(["Chat Models", "Code Models"])
     with tab1:
-        _plot_model_metrics(df, "chat_model")
+        st.image(_model_metrics_png(EVALUATION_LOG_PATH, mtime, "chat_model"), use_container_width=True)
     with tab2:
-        _plot_model_metrics(df, "code_model")
+        st.image(_model_metrics_png(EVALUATION_LOG_PATH, mtime, "code_model"), use_container_width=True)
 
     # Last 10 Recent evaluations
     st.subheader("Recent Evaluations")
     recent_df = df.sort_values("timestamp", ascending=False).head(10)
 
-    for _, row in recent_df[:10].iterrows():
+    for row in recent_df.to_dict('records'):
         with st.expander(f"{row['timestamp']} - {row['chat_model']}/{row['code_model']}"):
             col1, col2 = st.columns(2)
 
@@ -204,32 +316,47 @@ def render_evaluation_dashboard():
 
                 # Show code metrics if available
                 if row['code_metrics']:
-                    st.write("**Code Metrics:**")
-                    for key, value in row['code_metrics'].items():
-                        if isinstance(value, float):
-                            st.write(f"- {key.replace('_', ' ').title()}: {value:.2f}")
-                        else:
-                            st.write(f"- {key.replace('_', ' ').title()}: {value}")
+                    st.markdown(_format_code_metrics(row['code_metrics']))
+
+
+def _format_code_metrics(code_metrics: Dict[str, Any]) -> str:
+    """Format code metrics as a single markdown block, so they are sent to the page as one element."""
+    lines = ["**Code Metrics:**"]
+    for key, value in code_metrics.items():
+        label = _METRIC_LABELS.get(key) or key.replace('_', ' ').title()
+        lines.append(f"- {label}: {value:.2f}" if isinstance(value, float) else f"- {label}: {value}")
+    return "\n".join(lines)
 
 
-def _plot_model_metrics(df: pd.DataFrame, model_col: str):
-    """Plot performance metrics for different models."""
-    models = df[model_col].unique()
+def figure_png(fig) -> bytes:
+    """Render a figure to PNG like st.pyplot does, so dashboards can cache the image instead of redrawing it."""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight", dpi=200)
+    return buffer.getvalue()
+
+
+@_cache_data
+def _model_metrics_png(log_path: str, mtime: int, model_col: str) -> bytes:
+    """Chart of the per-model success rate and completion time side by side, drawn once per version of the log."""
+    from matplotlib.figure import Figure
+
+    aggregates = _aggregate(log_path, mtime, model_col)
+    label = model_col.replace('_', ' ').title()
+    # A bare Figure isn't registered with pyplot, so there is nothing to close
+    fig = Figure(figsize=(14, 5))
+    ax1, ax2 = fig.subplots(1, 2)
 
     # Success rate by model
-    success_by_model = df.groupby(model_col)["success"].mean() * 100
-    fig, ax = plt.subplots(figsize=(10, 5))
-    success_by_model.plot(kind="bar", ax=ax)
-    ax.set_xlabel(f"{model_col.replace('_', ' ').title()}(s)")
-    ax.set_ylabel("Success Rate (%)")
-    ax.set_title(f"Success Rate by {model_col.replace('_', ' ').title()}")
-    st.pyplot(fig)
+    aggregates["success"].plot(kind="bar", ax=ax1)
+    ax1.set_xlabel(f"{label}(s)")
+    ax1.set_ylabel("Success Rate (%)")
+    ax1.set_title(f"Success Rate by {label}")
 
     # Completion time by model
-    time_by_model = df.groupby(model_col)["completion_time"].mean()
-    fig, ax = plt.subplots(figsize=(10, 5))
-    time_by_model.plot(kind="bar", ax=ax)
-    ax.set_xlabel(f"{model_col.replace('_', ' ').title()}(s)")
-    ax.set_ylabel("Average Completion Time (s)")
-    ax.set_title(f"Completion Time by {model_col.replace('_', ' ').title()}")
-    st.pyplot(fig)
\ No newline at end of file
+    aggregates["time"].plot(kind="bar", ax=ax2)
+    ax2.set_xlabel(f"{label}(s)")
+    ax2.set_ylabel("Average Completion Time (s)")
+    ax2.set_title(f"Completion Time by {label}")
+
+    fig.tight_layout()
+    return figure_png(fig)
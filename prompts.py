@@ -1,8 +1,22 @@
 context = ("Purpose: The primary role of this agent is to assist users by analyzing code. It should be able to generate "
            "code and answer questions about code provided.")
 
+code_answer_context = (context + " When you give your final answer, reply only with a JSON object with the keys "
+                       "'code' (a string of valid code), 'description' (what the code does) and 'filename' (a valid "
+                       "filename without special characters).")
+
+# Appended to the prompt of each concurrent generation attempt, so the attempts explore different solutions
+candidate_variations = ("",
+                        " Prefer the simplest solution that fully answers the request.",
+                        " Handle errors and edge cases explicitly.")
+
 code_parser_template = ("Parse the response from the previous LLM into a description and a string of valid code. "
                         "also come up with a valid filename that could be saved which doesn't contain any special "
-                        "characters. Here is the response: {response}. "
+                        "characters. The response is given at the end. "
                         "You should parse this in the following JSON format: "
                         "Return only the JSON object.")
+
+
+single_code_template = ("Write code for the following request and return a JSON object with the keys 'code' (a string of "
+                        "valid code), 'description' (what the code does) and 'filename' (a valid filename without "
+                        "special characters). Here is the request: {prompt}. Return only the JSON object.")
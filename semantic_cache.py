@@ -0,0 +1,186 @@
+"""
+Embedding-similarity cache that returns stored results for near-duplicate texts,
+and an exact-match cache checked before it.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import orjson
+from sentence_transformers import SentenceTransformer
+
+DEFAULT_EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# Maximum number of entries a SemanticCache keeps
+SEMANTIC_CACHE_MAX_ENTRIES = 1000
+
+# Worker saving caches off the Streamlit script thread; a single one keeps the saves of a cache in order
+_save_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="semantic-cache")
+
+# Loaded encoders, shared by every cache instance in the process; the lock keeps concurrent sessions
+# from loading duplicates
+_encoders: Dict[str, SentenceTransformer] = {}
+_encoders_lock = threading.Lock()
+
+
+def _get_encoder(model_name: str) -> SentenceTransformer:
+    """Get or load a sentence embedding model."""
+    if model_name not in _encoders:
+        with _encoders_lock:
+            if model_name not in _encoders:
+                _encoders[model_name] = SentenceTransformer(model_name)
+    return _encoders[model_name]
+
+
+class SemanticCache:
+    """
+    A persistent cache mapping text embeddings to JSON-serializable results.
+    A lookup hits when the cosine similarity to a stored embedding exceeds the threshold.
+    """
+
+    def __init__(self, path: str, threshold: float = 0.92, model_name: str = DEFAULT_EMBED_MODEL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, version: str = ""):
+        """
+        Initialize the SemanticCache.
+
+        Args:
+            path: Path of the .npz file holding the cached embeddings and results
+            threshold: Minimum cosine similarity for a cache hit
+            model_name: Sentence-transformers model used to embed texts
+            max_entries: Maximum number of entries kept; the oldest ones are dropped beyond it
+            version: Identifier of what the results depend on; a cache saved with another version starts empty
+        """
+        self.path = path
+        self.threshold = threshold
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.version = version
+        self._embeddings = None
+        self._values: List[str] = []
+        # A cache may be shared by several Streamlit sessions
+        self._lock = threading.RLock()
+
+    def _load(self):
+        """Load the cached embeddings and results from disk on first use."""
+        with self._lock:
+            if self._embeddings is not None:
+                return
+
+            self._embeddings = np.zeros((0, 0), dtype=np.float32)
+            if os.path.exists(self.path):
+                try:
+                    with np.load(self.path) as data:
+                        version = str(data["version"]) if "version" in data.files else ""
+                        if version != self.version:
+                            return
+                        values = data["results"].tobytes().decode().split("\n")[:-1]
+                        if len(values) == len(data["embeddings"]):
+                            self._embeddings = data["embeddings"].astype(np.float32)
+                            self._values = values
+                except Exception as e:
+                    print(f"Error loading the semantic cache: {e}")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into unit-length float32 vectors, one row per text."""
+        embeddings = _get_encoder(self.model_name).encode(texts, normalize_embeddings=True)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def lookup(self, embedding: np.ndarray, threshold: Optional[float] = None) -> Optional[Any]:
+        """
+        Return the result stored for the most similar embedding, or None on a miss.
+        A threshold overrides the cache's own minimum similarity for this lookup.
+        """
+        self._load()
+        with self._lock:
+            if not self._values:
+                return None
+            similarities = self._embeddings @ embedding
+            # The latest entry wins a tie, so a regenerated result replaces the one stored for the same text
+            best = len(similarities) - 1 - int(similarities[::-1].argmax())
+            if similarities[best] < (self.threshold if threshold is None else threshold):
+                return None
+            return orjson.loads(self._values[best])
+
+    def add(self, embedding: np.ndarray, value: Any):
+        """Store a result for an embedding, dropping the oldest entries beyond max_entries. Call save() to persist."""
+        self._load()
+        row = embedding.reshape(1, -1)
+        with self._lock:
+            self._embeddings = row if not self._values else np.vstack([self._embeddings, row])
+            self._values.append(orjson.dumps(value).decode())
+            if len(self._values) > self.max_entries:
+                self._embeddings = self._embeddings[-self.max_entries:]
+                self._values = self._values[-self.max_entries:]
+
+    def save(self):
+        """Persist the cache to disk in the background."""
+        if self._embeddings is None:
+            return
+
+        with self._lock:
+            # add() replaces the embeddings array rather than changing it; the results list is copied
+            embeddings, values = self._embeddings, list(self._values)
+        _save_pool.submit(self._write, embeddings, values)
+
+    def _write(self, embeddings: np.ndarray, values: List[str]):
+        """
+        Write a snapshot of the cache. The results are stored as JSON Lines bytes rather than a unicode array,
+        which would pad every result to the longest one, and the file is replaced at once so a reader never sees
+        a partial write.
+        """
+        cache_dir = os.path.dirname(self.path)
+        temp_path = f"{self.path}.tmp"
+        try:
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            results = np.frombuffer("".join(f"{value}\n" for value in values).encode(), dtype=np.uint8)
+            with open(temp_path, "wb") as f:
+                np.savez(f, embeddings=embeddings, results=results, version=np.array(self.version))
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving the semantic cache: {e}")
+
+
+class ExactCache:
+    """
+    An in-memory cache mapping texts to results, checked before the SemanticCache since a lookup needs no embedding.
+    Entries expire after ttl seconds, and the least recently used one is evicted beyond max_entries.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 512):
+        """
+        Initialize the ExactCache.
+
+        Args:
+            ttl: Seconds an entry stays valid
+            max_entries: Maximum number of entries kept
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # text -> (expiry time, result), least recently used first
+        # A cache may be shared by several Streamlit sessions
+        self._lock = threading.Lock()
+
+    def get(self, text: str) -> Optional[Any]:
+        """Return the result stored for the text, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(text)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[text]
+                return None
+            self._entries.move_to_end(text)
+            return value
+
+    def add(self, text: str, value: Any):
+        """Store a result for the text."""
+        with self._lock:
+            self._entries[text] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -1,14 +1,22 @@
-import json
+import hashlib
+import importlib
 import os
-import traceback
 import uuid
+from functools import partial
 
 import streamlit as st
 
-from main import initialize_ai_components
-from model_registry import CHAT_MODELS, CODE_MODELS
+from main import (initialize_ai_components, data_fingerprint, get_prompt_cache, get_response_cache, classify_prompt,
+                  generate_code_directly, DATA_DIR)
+from generation import run_generation, MAX_RETRIES
+import model_registry
 from model_evaluator import render_evaluation_dashboard
-from feedback_manager import FeedbackManager, render_feedback_dashboard
+from feedback_manager import get_feedback_manager, render_feedback_dashboard
+from ui import (StreamlitProgress, render_response, save_response, report_saves, submit_feedback, init_history,
+                add_to_history, history_blob, render_history, render_archived_history)
+
+# Size of the blocks uploads are hashed and written in
+UPLOAD_CHUNK_SIZE = 1 << 20
 
 # Set page configuration
 st.set_page_config(
@@ -20,26 +28,45 @@ st.set_page_config(
 st.title("Multimodal AI Code Generator")
 st.markdown("Generate code from natural language prompts and uploaded files!")
 
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _models():
+    """The registry's chat and code models, reloaded every 5 minutes so edits to it apply without a restart."""
+    importlib.reload(model_registry)
+    return model_registry.CHAT_MODELS, model_registry.CODE_MODELS
+
+
 # Initialize AI components
+chat_models, code_models = _models()
 st.sidebar.header("⚙ Settings")
-chat_model = st.sidebar.selectbox("Chat / Reasoning model", CHAT_MODELS, index=0)
-code_model = st.sidebar.selectbox("Code‑generation model", CODE_MODELS, index=0)
-agent, output_pipeline, model_evaluator = initialize_ai_components(chat_model, code_model)
+chat_model = st.sidebar.selectbox("Chat / Reasoning model", chat_models, index=0)
+code_model = st.sidebar.selectbox("Code‑generation model", code_models, index=0)
+cache_threshold = st.sidebar.slider("Prompt cache similarity", min_value=0.80, max_value=1.00, value=0.92, step=0.01,
+                                    help="Reuse a previous response when a prompt is at least this similar to an "
+                                         "earlier one. Set to 1.00 to only reuse identical prompts.")
+# Identifies the contents of the data directory; the index and the response caches follow it
+fingerprint = data_fingerprint()
+new_agent, output_formatter, model_evaluator = initialize_ai_components(chat_model, code_model, fingerprint)
+prompt_cache = get_prompt_cache(chat_model, code_model, fingerprint)
+response_cache = get_response_cache(chat_model, code_model, fingerprint)
 
 # Initialize feedback manager
-feedback_manager = FeedbackManager()
+feedback_manager = get_feedback_manager()
 
 # Initialize session state for file tracking
 if 'uploaded_files' not in st.session_state:
     st.session_state.uploaded_files = []
-
-# Initialize session state for IDs
-if 'code_ids' not in st.session_state:
-    st.session_state.code_ids = {}
+    st.session_state.upload_hashes = {}
+    st.session_state.upload_file_ids = set()
 
 # Initialize session state for storing history
-if 'history' not in st.session_state:
-    st.session_state.history = []
+init_history()
+
+# Initialize session state for the content hash of each file saved to output/, and the writes still running
+if 'saved_hashes' not in st.session_state:
+    st.session_state.saved_hashes = {}
+    st.session_state.pending_writes = []
 
 # Initialize session state for tracking current feedback
 if 'current_code_id' not in st.session_state:
@@ -49,15 +76,42 @@ if 'current_code_id' not in st.session_state:
 if 'feedback_submitted' not in st.session_state:
     st.session_state.feedback_submitted = False
 
+# Initialize session state for counting the responses served by each cache layer
+if 'cache_stats' not in st.session_state:
+    st.session_state.cache_stats = {"exact": 0, "semantic": 0, "miss": 0}
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file on disk, read in blocks (empty string if the file doesn't exist)."""
+    if not os.path.exists(path):
+        return ""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_upload(uploaded_file, data_dir: str) -> bool:
+    """
+    Stream an uploaded file into the data directory in blocks, without copying it in memory.
+    The write is skipped when the same content is already saved, which also keeps the vector index from being rebuilt.
+    Returns: bool: True if the file was written
+    """
+    file_path = os.path.join(data_dir, uploaded_file.name)
+    upload_digest = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+    saved_digests = st.session_state.upload_hashes
+    if saved_digests.get(file_path) == upload_digest or file_digest(file_path) == upload_digest:
+        saved_digests[file_path] = upload_digest
+        return False
 
-# Function to handle feedback submission
-def submit_feedback(rating, code_id, comment, chat_model, code_model, code=None, prompt=None, description=None):
-    feedback_success = feedback_manager.record_feedback(
-        rating, code_id, comment, chat_model, code_model, code=code, prompt=prompt, code_description=description
-    )
-    if feedback_success:
-        st.session_state.feedback_submitted = True
-    return feedback_success
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        for chunk in iter(lambda: uploaded_file.read(UPLOAD_CHUNK_SIZE), b""):
+            f.write(chunk)
+    uploaded_file.seek(0)
+    saved_digests[file_path] = upload_digest
+    return True
 
 
 # Add file uploader section
@@ -68,16 +122,13 @@ uploaded_file = st.sidebar.file_uploader(
     type=["pdf", "py", "js", "html", "css", "java", "cpp", "txt"],
 )
 
-# Handle file upload
-if uploaded_file:
-    data_dir = "data"
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
+# Handle file upload. The file ID stays the same across reruns until a file is uploaded again,
+# so an upload is only hashed and saved on the rerun it arrives in
+if uploaded_file and uploaded_file.file_id not in st.session_state.upload_file_ids:
+    st.session_state.upload_file_ids.add(uploaded_file.file_id)
 
-    # Save the file
-    file_path = os.path.join(data_dir, uploaded_file.name)
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+    # Save the file, unless this exact content is already there
+    save_upload(uploaded_file, DATA_DIR)
 
     # Add to session state if not already there
     if uploaded_file.name not in st.session_state.uploaded_files:
@@ -93,6 +144,8 @@ with tab1:
                               height=100,
                               placeholder="Example: Read the contents of test.py and write a python script that calls the "
                                           "post endpoint to make a new item")
+        regenerate = st.checkbox("Regenerate (skip the cache)",
+                                 help="Generate a new response even if one is cached for this prompt, replacing it.")
         submitted = st.form_submit_button("Generate Response")
 
     # Process when form is submitted
@@ -100,130 +153,41 @@ with tab1:
         # Reset feedback state for new generation
         st.session_state.feedback_submitted = False
 
-        # Create a placeholder for displaying progress
-        retry_placeholder = st.empty()
-        progress_placeholder = st.empty()
-        status_container = st.container()
+        # Create the status widget displaying progress
+        progress = StreamlitProgress(MAX_RETRIES)
 
         # Start the evaluation
         model_evaluator.start_evaluation(chat_model, code_model, prompt)
 
-        with st.spinner("Generating code..."):
-            max_retries = 3
-            retries = 0
-            success = False
-            error_context = ""
-            retry_prompt = prompt
-            while retries < max_retries and not success:
-                try:
-                    if retries > 0:
-                        retry_prompt = f"Original request: {prompt}  \nPrevious attempt failed with the following error:  \n{error_context[:400]}...  \nPlease generate a correct solution that avoids this error to respond to original request."
-                        with status_container:
-                            st.info(f"**Previous attempt failed with error:**  \n{error_context[:400]}...  \n**Retrying with this new knowledge.**")
-
-                        # Record retry in evaluation
-                        model_evaluator.record_retry(error_context)
-
-                    # Get result from agent
-                    progress_placeholder.info("Querying AI agent...")
-                    result = agent.query(retry_prompt)
-                    progress_placeholder.info("Processing response...")
-
-                    # Get formatted result and parse JSON
-                    next_result = output_pipeline.run(response=result)
-                    cleaned_json = str(next_result).replace("assistant:", "").strip()
-
-                    # Check if result was in JSON format
-                    try:
-                        cleaned_json = json.loads(cleaned_json)
-                        is_json = True
-                    except Exception:
-                        is_json = False
-
-                    progress_placeholder.info("Displaying results...")
-
-                    # Display the results if output was in desired JSON format or (maybe) retry again
-                    if is_json:
-                        st.subheader("Response")
-                        st.markdown(f"**Description:** {cleaned_json['description']}")
-                        if cleaned_json['code']:
-                            st.code(cleaned_json['code'], language="python")
-                            st.markdown(f"**Filename:** {cleaned_json['filename']}")
-                            # Add a download button
-                            st.download_button(
-                                label=f"Download {cleaned_json['filename']}",
-                                data=f"'''{cleaned_json['description']}'''\n{cleaned_json['code']}",
-                                file_name=cleaned_json['filename'],
-                                mime="text/plain"
-                            )
-                    elif retries < 2:
-                        raise ValueError("Response not in desired format.")
-                    else:
-                        st.subheader("Response")
-                        st.warning("Unable to generate a structured response. Loading raw response.")
-                        st.write(cleaned_json)
-
-                        # Record partial success in evaluation
-                        model_evaluator.record_success({"code": str(cleaned_json)})
-
-                    # Record success in evaluation
-                    completion_time = model_evaluator.record_success(cleaned_json)
-
-                    # Generate a unique ID for this code generation
-                    code_id = f"code_{uuid.uuid4().hex[:8]}"
-                    st.session_state.code_ids[len(st.session_state.history)] = code_id
-                    st.session_state.current_code_id = code_id  # Store current code ID
-
-                    status_container.empty()
-                    success = True
-                    progress_placeholder.success("Code Generated Successfully!")
-
-                    try:
-                        if not os.path.exists('output'):
-                            os.makedirs('output')
-
-                        with open(os.path.join("output", cleaned_json['filename']), "w") as file:
-                            file.write(f"'''\n{cleaned_json['description']}\n'''\n")
-                            file.write(cleaned_json['code'])
-                        st.success(f"Code saved to 'output/{cleaned_json['filename']}'")
-                    except Exception as e:
-                        st.error(f"There was an error generating the file: {e[:200]}...")
-
-                    # Show completion time
-                    st.info(f"Code generated in {completion_time:.2f} seconds")
-
-                    # Add to history
-                    st.session_state.history.append(cleaned_json)
-
-                except Exception as e:
-                    try:
-                        with st.expander(f"Response from attempt {retries + 1}"):
-                            st.code(cleaned_json)
-                    except:
-                        try:
-                            with st.expander(f"Response from attempt {retries + 1}"):
-                                st.code(next_result)
-                        except:
-                            try:
-                                with st.expander(f"Response from attempt {retries + 1}"):
-                                    st.code(result)
-                            except:
-                                pass
-                    retries += 1
-                    error_msg = str(e)
-                    error_traceback = traceback.format_exc()
-                    error_context = f"{error_msg}\n\nDetails: {error_traceback[-200:]}..."
-                    retry_placeholder.warning(f"Retry attempt {retries}/{max_retries}...")
-
-                    if retries >= max_retries:
-                        progress_placeholder.error(f"Failed after {max_retries} attempts")
-                        with status_container:
-                            st.error(f"**An error occurred:** {error_msg[:300]}  \n**Please try again with a different prompt.**")
-                            with st.expander("See detailed error"):
-                                st.code(error_traceback)
-
-                        # Record failure in evaluation
-                        model_evaluator.record_failure(error_context)
+        # Short, self-contained code requests go to the code model directly, before involving the agent
+        simple = classify_prompt(prompt, st.session_state.uploaded_files) == "simple"
+        direct = partial(generate_code_directly, code_model=code_model) if simple else None
+
+        result = run_generation(new_agent, output_formatter, prompt, model_evaluator=model_evaluator,
+                                prompt_cache=prompt_cache, cache_threshold=cache_threshold,
+                                response_cache=response_cache, direct=direct, skip_cache=regenerate,
+                                progress=progress)
+        st.session_state.cache_stats[result.cache_layer or "miss"] += 1
+
+        progress.show_result(result)
+        if result.succeeded:
+            payload = render_response(result)
+
+            # Generate a unique ID for this code generation
+            code_id = f"code_{uuid.uuid4().hex[:8]}"
+            st.session_state.current_code_id = code_id  # Store current code ID
+
+            if result.is_json:
+                save_response(result.cleaned_json, payload)
+
+            # Show completion time
+            st.info(f"Code generated in {result.completion_time:.2f} seconds")
+
+            # Add to history
+            add_to_history(result.cleaned_json, code_id, payload)
+
+    # Display the outcome of the files saved in the background
+    report_saves()
 
     # Display feedback section for the current result
     if st.session_state.current_code_id and not st.session_state.feedback_submitted:
@@ -232,77 +196,43 @@ with tab1:
             st.markdown("#### Was this response helpful?")
             feedback_comment = st.text_area("Additional comments (optional):", key="current_feedback_comment")
 
-            col1, col2, col3, col4, col5 = st.columns(5)
-            for i, col in enumerate([col1, col2, col3, col4, col5], 1):
-                if col.button(f"{i * '⭐'}", key=f"current_rating_{i}"):
-                    # Get the current code details from the last result
-                    current_code = None
-                    current_prompt = None
-                    current_description = None
-                    if st.session_state.history:
-                        last_result = st.session_state.history[-1]
-                        current_code = last_result.get('code')
-                        current_description = last_result.get('description')
-                        
-                    feedback_success = submit_feedback(
-                        i, st.session_state.current_code_id, feedback_comment,
-                        chat_model, code_model,
-                        code=current_code,
-                        prompt=prompt,  # Using the prompt from the form
-                        description=current_description
-                    )
-                    if feedback_success:
-                        st.success("Thank you for your feedback!")
-                    else:
-                        st.error("Error recording feedback. Please try again.")
+            # Keyed by the code ID, so a new result doesn't inherit the previous result's rating
+            rating = st.feedback("stars", key=f"current_rating_{st.session_state.current_code_id}")
+            if rating is not None:
+                # Get the current code details from the last result
+                current_code = None
+                current_description = None
+                last_result = history_blob(st.session_state.current_code_id)
+                if isinstance(last_result, dict):
+                    current_code = last_result.get('code')
+                    current_description = last_result.get('description')
+
+                feedback_success = submit_feedback(
+                    feedback_manager, rating + 1, st.session_state.current_code_id, feedback_comment,
+                    chat_model, code_model,
+                    code=current_code,
+                    prompt=prompt,  # Using the prompt from the form
+                    description=current_description
+                )
+                if feedback_success:
+                    st.success("Thank you for your feedback!")
+                else:
+                    st.error("Error recording feedback. Please try again.")
         else:
             st.markdown("---")
             st.success("Feedback already recorded for this response. Thank you!")
 
     # Display history if it isn't empty
-    if st.session_state.history:
-        st.markdown("---")
-        st.subheader("Model History")
-        for i, entry in enumerate(st.session_state.history):
-            try:
-                # Get code ID or create one if it doesn't exist
-                if i not in st.session_state.code_ids:
-                    st.session_state.code_ids[i] = f"history_{uuid.uuid4().hex[:8]}"
-                code_id = st.session_state.code_ids[i]
-
-                with st.expander(f"#{i + 1}: {entry['filename']} - {entry['description']}"):
-                    st.code(entry['code'], language="python")
-                    st.download_button(
-                        label=f"Download {entry['filename']}",
-                        data=f"'''{entry['description']}'''\n{entry['code']}",
-                        file_name=entry['filename'],
-                        mime="text/plain",
-                        key=f"download_button_{i}"
-                    )
-
-                    # Add feedback for historical items
-                    if feedback_manager.is_feedback_recorded(code_id):
-                        st.success("Feedback already recorded for this response.")
-                    else:
-                        st.write("Rate this code:")
-                        feedback_cols = st.columns(5)
-                        feedback_comment = st.text_area("Additional comments (optional):", key=f"history_comment_{i}")
-                        for j, fcol in enumerate(feedback_cols, 1):
-                            if fcol.button(f"{j * '⭐'}", key=f"history_rating_{j}_{code_id}"):
-                                feedback_success = submit_feedback(
-                                    j, code_id, feedback_comment,
-                                    chat_model, code_model,
-                                    code=entry['code'],
-                                    prompt='Unavailable',
-                                    description=entry['description']
-                                )
-                                if feedback_success:
-                                    st.success("Feedback recorded!")
-                                else:
-                                    st.error("Error recording feedback. Please try again.")
-            except Exception as e:
-                with st.expander(f"#{i + 1}: {entry[:200]}"):
-                    st.write(entry)
+    render_history(feedback_manager, chat_model, code_model)
+
+    # Archived history is only read from disk when requested
+    if st.sidebar.toggle("Show archived history"):
+        render_archived_history()
+
+    # Responses served by each cache layer this session, counted after this run's generation
+    cache_stats = st.session_state.cache_stats
+    st.sidebar.caption(f"Cache hits this session: {cache_stats['exact']} exact, {cache_stats['semantic']} similar, "
+                       f"{cache_stats['miss']} misses")
 
 with tab2:
     render_evaluation_dashboard()
@@ -0,0 +1,99 @@
+import gc
+import os
+
+import orjson
+import pandas as pd
+import pytest
+
+import feedback_manager
+from feedback_manager import FeedbackManager, _LogWriter, _rating_counts
+
+
+def test_rating_counts():
+    df = pd.DataFrame({"rating": [5, 3, 5, 1]})
+    assert _rating_counts(df).to_dict() == {1: 1, 2: 0, 3: 1, 4: 0, 5: 2}
+
+
+def test_rating_counts_skips_missing_and_out_of_range_ratings():
+    df = pd.DataFrame({"rating": [4, None, -1, 0, 6, 2.0, "3"]})
+    assert _rating_counts(df).to_dict() == {1: 0, 2: 1, 3: 1, 4: 1, 5: 0}
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    # Writes only happen on explicit flushes
+    monkeypatch.setattr(feedback_manager, "FLUSH_INTERVAL", 3600)
+    return str(tmp_path / "logs" / "user_feedback.jsonl")
+
+
+def test_feedback_is_buffered_until_flushed(log_path):
+    manager = FeedbackManager(log_path)
+    assert manager.record_feedback(4, "code_1", "nice")
+    assert manager.is_feedback_recorded("code_1")
+    assert FeedbackManager.load_feedback(log_path) == []
+
+    manager.flush()
+    entries = FeedbackManager.load_feedback(log_path)
+    assert [(entry["code_id"], entry["rating"], entry["comment"]) for entry in entries] == [("code_1", 4, "nice")]
+    manager.close()
+
+
+def test_feedback_is_recorded_once_per_code_id(log_path):
+    manager = FeedbackManager(log_path)
+    manager.record_feedback(4, "code_1")
+    manager.record_feedback(1, "code_1")
+    manager.close()
+
+    reloaded = FeedbackManager(log_path)
+    assert reloaded.bulk_is_recorded(["code_1", "code_2"]) == {"code_1"}
+    reloaded.record_feedback(2, "code_1")
+    reloaded.close()
+    assert [entry["rating"] for entry in FeedbackManager.load_feedback(log_path)] == [4]
+
+
+def test_buffered_feedback_is_written_when_the_manager_is_released(log_path):
+    manager = FeedbackManager(log_path)
+    manager.record_feedback(5, "code_1")
+    del manager
+    gc.collect()
+    assert [entry["code_id"] for entry in FeedbackManager.load_feedback(log_path)] == ["code_1"]
+
+
+def test_log_writer_keeps_lines_after_a_failed_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(feedback_manager, "FLUSH_INTERVAL", 3600)
+    writer = _LogWriter(str(tmp_path / "missing" / "log.jsonl"))
+    writer.append(b"1\n")
+    writer.append(b"2\n")
+    writer.flush()
+    (tmp_path / "missing").mkdir()
+    writer.append(b"3\n")
+    writer.close()
+    assert (tmp_path / "missing" / "log.jsonl").read_bytes() == b"1\n2\n3\n"
+
+
+def test_legacy_json_log_is_converted_once(log_path):
+    legacy_path = log_path.removesuffix("l")
+    os.makedirs(os.path.dirname(log_path))
+    with open(legacy_path, "wb") as f:
+        f.write(orjson.dumps([{"code_id": "old_1", "rating": 3}, {"code_id": "old_2", "rating": None}]))
+
+    manager = FeedbackManager(log_path)
+    assert manager.bulk_is_recorded(["old_1", "old_2", "new"]) == {"old_1", "old_2"}
+    assert not os.path.exists(legacy_path) and os.path.exists(legacy_path + ".migrated")
+    manager.close()
+
+    FeedbackManager(log_path).close()
+    assert [entry["code_id"] for entry in FeedbackManager.load_feedback(log_path)] == ["old_1", "old_2"]
+
+
+def test_legacy_json_log_is_not_converted_into_a_used_log(log_path):
+    legacy_path = log_path.removesuffix("l")
+    os.makedirs(os.path.dirname(log_path))
+    with open(log_path, "wb") as f:
+        f.write(orjson.dumps({"code_id": "new", "rating": 5}) + b"\n")
+    with open(legacy_path, "wb") as f:
+        f.write(orjson.dumps([{"code_id": "old_1", "rating": 3}]))
+
+    FeedbackManager(log_path).close()
+    assert [entry["code_id"] for entry in FeedbackManager.load_feedback(log_path)] == ["new"]
+    assert os.path.exists(legacy_path)
@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+import generation
+from generation import run_generation, RETRY_TMPL
+from main import CircuitBreaker
+from semantic_cache import ExactCache, SemanticCache
+
+CODE_OUTPUT = {"code": "print(1)", "description": "Prints 1", "filename": "one.py"}
+
+
+class FakeGeneration:
+    """
+    Stands in for the agent attempts run_generation starts, returning the given outcomes in order
+    and recording the prompt of each attempt.
+    """
+
+    def __init__(self, monkeypatch, *outcomes):
+        self.outcomes = list(outcomes)
+        self.prompts = []
+        monkeypatch.setattr(generation, "generation_breaker", CircuitBreaker())
+        monkeypatch.setattr(generation, "generate_code", self.generate_code)
+        monkeypatch.setattr(generation, "submit_generation_attempts", lambda factory, formatter, prompt: prompt)
+        monkeypatch.setattr(generation, "start_stream_generation", lambda agent, prompt: prompt)
+        monkeypatch.setattr(generation, "stream_generation", self.stream_generation)
+        monkeypatch.setattr(generation, "finish_generation", lambda answer, formatter: self.next())
+
+    def next(self):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def generate_code(self, agent_factory, output_formatter, prompt, on_partial=None, submitted=None):
+        # A retry's attempts are submitted beforehand with the same prompt
+        assert submitted in (None, prompt)
+        self.prompts.append(prompt)
+        return self.next()
+
+    def stream_generation(self, started):
+        self.prompts.append(started)
+        yield "streamed answer"
+
+
+def _run(prompt="write a function", **kwargs):
+    return run_generation(lambda: None, None, prompt, **kwargs)
+
+
+def test_first_complete_code_output_is_returned(monkeypatch):
+    fake = FakeGeneration(monkeypatch, ("{...}", CODE_OUTPUT, None))
+    result = _run()
+    assert result.cleaned_json == CODE_OUTPUT and result.is_json
+    assert result.attempts == 1
+    assert fake.prompts == ["write a function"]
+
+
+def test_failed_attempts_are_retried_with_the_error(monkeypatch):
+    fake = FakeGeneration(monkeypatch, ("not json", None, None), ("{...}", CODE_OUTPUT, None))
+    result = _run()
+    assert result.cleaned_json == CODE_OUTPUT
+    assert result.attempts == 2
+    error = "ValueError: Response is not a JSON object with the fields code, description, filename."
+    assert fake.prompts[1] == RETRY_TMPL.format(prompt="write a function", error=error)
+
+
+def test_last_attempt_accepts_a_raw_response(monkeypatch):
+    fake = FakeGeneration(monkeypatch, ("not json", None, None), TimeoutError("too slow"),
+                          ("still not json", None, None))
+    result = _run()
+    assert result.succeeded and not result.is_json
+    assert result.cleaned_json == "still not json"
+    assert result.attempts == 3
+    assert "LLM timed out: too slow" in fake.prompts[2]
+
+
+def test_every_attempt_failing_returns_the_last_error(monkeypatch):
+    FakeGeneration(monkeypatch, ValueError("bad"), ValueError("worse"), ValueError("worst"))
+    result = _run()
+    assert not result.succeeded
+    assert result.error == "worst"
+    assert result.attempts == 3
+
+
+def test_direct_answer_skips_the_agent(monkeypatch):
+    fake = FakeGeneration(monkeypatch)
+    result = _run(direct=lambda prompt: ("{...}", CODE_OUTPUT))
+    assert result.cleaned_json == CODE_OUTPUT
+    assert fake.prompts == []
+
+
+def test_incomplete_direct_answer_falls_back_to_the_agent(monkeypatch):
+    fake = FakeGeneration(monkeypatch, ("{...}", CODE_OUTPUT, None))
+    result = _run(direct=lambda prompt: ("not json", None))
+    assert result.cleaned_json == CODE_OUTPUT
+    assert result.attempts == 1
+    assert fake.prompts == ["write a function"]
+
+
+@pytest.fixture
+def prompt_cache(tmp_path, monkeypatch):
+    cache = SemanticCache(str(tmp_path / "cache.npz"))
+    monkeypatch.setattr(cache, "embed", lambda texts: np.ones((len(texts), 2), dtype=np.float32) / np.sqrt(2))
+    return cache
+
+
+def test_results_are_cached_and_reused(monkeypatch, prompt_cache):
+    FakeGeneration(monkeypatch, ("{...}", CODE_OUTPUT, None))
+    response_cache = ExactCache()
+    _run(response_cache=response_cache, prompt_cache=prompt_cache)
+
+    exact = _run(response_cache=response_cache, prompt_cache=prompt_cache)
+    assert exact.cache_layer == "exact" and exact.cleaned_json == CODE_OUTPUT
+    similar = _run("write the function", response_cache=response_cache, prompt_cache=prompt_cache)
+    assert similar.cache_layer == "semantic" and similar.cleaned_json == CODE_OUTPUT
+
+
+def test_skip_cache_generates_and_replaces_the_cached_result(monkeypatch, prompt_cache):
+    regenerated = {**CODE_OUTPUT, "code": "print(2)"}
+    FakeGeneration(monkeypatch, ("{...}", regenerated, None))
+    response_cache = ExactCache()
+    response_cache.add("write a function", CODE_OUTPUT)
+    prompt_cache.add(prompt_cache.embed(["write a function"])[0], CODE_OUTPUT)
+
+    result = _run(response_cache=response_cache, prompt_cache=prompt_cache, skip_cache=True)
+    assert result.cache_layer is None and result.cleaned_json == regenerated
+    assert response_cache.get("write a function") == regenerated
+    assert _run("write the function", prompt_cache=prompt_cache).cleaned_json == regenerated
+
+
+def test_raw_responses_are_not_cached(monkeypatch, prompt_cache):
+    FakeGeneration(monkeypatch, ("not json", None, None))
+    response_cache = ExactCache()
+    result = _run(response_cache=response_cache, prompt_cache=prompt_cache, max_retries=1)
+    assert result.cleaned_json == "not json"
+    assert response_cache.get("write a function") is None
@@ -0,0 +1,188 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+from llama_index.core import PromptTemplate
+
+import main
+from main import (CircuitBreaker, CircuitOpenError, GenerationAttempts, finish_generation, generate_code,
+                  format_code_output, partial_json_string, _clean_and_parse, _repair_json)
+
+
+class FakeClock:
+    """Stands in for time.monotonic, advanced by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    return fake
+
+
+def test_breaker_opens_after_threshold_timeouts(clock):
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_timeout()
+    breaker.check()
+    breaker.record_timeout()
+    assert breaker.remaining() == 60
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_breaker_closes_after_cooldown(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=60)
+    breaker.record_timeout()
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    clock.now += 1
+    assert breaker.remaining() == 0
+    breaker.check()
+
+
+def test_breaker_success_resets_the_count(clock):
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_timeout()
+    breaker.record_success()
+    breaker.record_timeout()
+    breaker.check()
+
+
+def test_circuit_open_error_is_a_timeout():
+    assert issubclass(CircuitOpenError, TimeoutError)
+
+
+CODE_OUTPUT = {"code": "print(1)", "description": "Prints 1", "filename": "one.py"}
+
+
+def _finished_attempts(*outcomes):
+    """GenerationAttempts whose attempts have already returned the given outcomes, in order."""
+    futures = []
+    for outcome in outcomes:
+        future = Future()
+        future.set_result(outcome)
+        futures.append(future)
+    return GenerationAttempts(futures, {}, threading.Event())
+
+
+def test_generate_code_prefers_a_complete_code_output():
+    submitted = _finished_attempts(("{}", {"code": "print(1)"}, None), ("not json", None, None),
+                                   ("{...}", CODE_OUTPUT, (10, 5)))
+    outcome = asyncio.run(generate_code(None, None, "prompt", submitted=submitted))
+    assert outcome == ("{...}", CODE_OUTPUT, (10, 5))
+    assert submitted.stop.is_set()
+
+
+def test_generate_code_falls_back_to_the_first_completed_attempt():
+    submitted = _finished_attempts(("not json", None, None), ("still not json", None, None))
+    outcome = asyncio.run(generate_code(None, None, "prompt", submitted=submitted))
+    assert outcome[1] is None
+
+
+def test_generate_code_raises_when_every_attempt_failed():
+    future = Future()
+    future.set_exception(ValueError("no answer"))
+    submitted = GenerationAttempts([future], {}, threading.Event())
+    with pytest.raises(ValueError, match="no answer"):
+        asyncio.run(generate_code(None, None, "prompt", submitted=submitted))
+
+
+def test_finish_generation_drops_an_incomplete_formatted_output():
+    formatter = lambda answer, on_partial=None, stop=None: ('{"code": "print(1)"}', (10, 5))
+    assert finish_generation("Here is the code", formatter) == ('{"code": "print(1)"}', None, (10, 5))
+
+
+def test_finish_generation_skips_the_formatter_for_a_code_output():
+    answer = '{"code": "print(1)", "description": "Prints 1", "filename": "one.py"}'
+    assert finish_generation(answer, None) == (answer, CODE_OUTPUT, None)
+
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"code": "x", "description": "d", "filename": "a.py"}\n```',
+    'Here is the result: {"code": "x", "description": "d", "filename": "a.py"} Hope this helps!',
+    "{'code': 'x', 'description': 'd', 'filename': 'a.py',}",
+    '{code: "x", description: "d", filename: "a.py"}',
+])
+def test_repair_json(text):
+    assert _repair_json(text) == {"code": "x", "description": "d", "filename": "a.py"}
+
+
+@pytest.mark.parametrize("text", [
+    "no json here",
+    "} reversed {",
+    '{"code": ',
+    "Sure: {'code': 'x', 'filename': 'a.py',}",
+])
+def test_repair_json_gives_up(text):
+    assert _repair_json(text) is None
+
+
+def test_clean_and_parse_returns_a_fresh_object():
+    raw = "assistant: {'code': 'x', 'description': 'd', 'filename': 'a.py'}"
+    first = _clean_and_parse(raw)[1]
+    first["code"] = "changed"
+    assert _clean_and_parse(raw) == (raw.removeprefix("assistant: "), {"code": "x", "description": "d", "filename": "a.py"})
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"description": "x"', None),
+    ('{"code": ', None),
+    ('{"code": "', ""),
+    ('{"code": "print(1)\\nprint(2)', "print(1)\nprint(2)"),
+    ('{"code": "a\\', "a"),
+    ('{"code": "a\\u00e', "a"),
+    ('{"code": "a\\u00e9b', "aéb"),
+    ('{"code": "say \\"hi\\"", "filename": "x.py"}', 'say "hi"'),
+])
+def test_partial_json_string(text, expected):
+    assert partial_json_string(text) == expected
+
+
+def test_partial_json_string_other_field():
+    assert partial_json_string('{"code": "x", "filename": "ma', field="filename") == "ma"
+
+
+class FakeStreamLLM:
+    """Stands in for the Ollama LLM, streaming a fixed response in chunks of a few characters."""
+
+    def __init__(self, text, size=4):
+        self.chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        self.streamed = 0
+        self.closed = False
+
+    def stream_complete(self, prompt, **kwargs):
+        try:
+            for i, delta in enumerate(self.chunks):
+                self.streamed += 1
+                done = i == len(self.chunks) - 1
+                yield SimpleNamespace(delta=delta, raw={"done": done, "prompt_eval_count": 200, "eval_count": 30})
+        finally:
+            self.closed = True
+
+
+def test_format_code_output_streams_partial_code(monkeypatch):
+    monkeypatch.setattr(main, "PREVIEW_STEP", 8)
+    text = '{"code": "print(1)\\nprint(2)", "description": "d", "filename": "a.py"}'
+    partials = []
+    formatted, usage = format_code_output(FakeStreamLLM(text), PromptTemplate("{response}"), "answer",
+                                          on_partial=partials.append)
+    assert formatted == text
+    assert usage == (200, 30)
+    assert partials and partials[-1] == "print(1)\nprint(2)"
+
+
+def test_format_code_output_stops_on_a_non_json_response():
+    llm = FakeStreamLLM("I cannot format this answer as JSON.")
+    formatted, usage = format_code_output(llm, PromptTemplate("{response}"), "answer")
+    assert formatted == "I ca"
+    assert usage is None
+    assert llm.streamed == 1 and llm.closed
@@ -0,0 +1,48 @@
+import os
+
+import orjson
+
+import model_evaluator
+from model_evaluator import ModelEvaluator
+
+
+def _wait_for_writes():
+    model_evaluator._get_log_pool().submit(lambda: None).result()
+
+
+def test_evaluations_are_appended_as_json_lines(tmp_path):
+    log_path = str(tmp_path / "logs" / "model_evaluations.jsonl")
+    for code_model in ("codellama", "deepseek-coder"):
+        evaluator = ModelEvaluator(log_path)
+        evaluator.start_evaluation("mistral", code_model, "write a function")
+        evaluator.record_success({"code": "# one\nprint(1)\n"})
+    _wait_for_writes()
+
+    evaluations = ModelEvaluator.load_evaluations(log_path)
+    assert [evaluation["code_model"] for evaluation in evaluations] == ["codellama", "deepseek-coder"]
+    assert evaluations[0]["success"] and evaluations[0]["code_metrics"]["has_comments"]
+
+
+def test_legacy_json_log_is_converted_once(tmp_path):
+    log_path = str(tmp_path / "model_evaluations.jsonl")
+    legacy_path = str(tmp_path / "model_evaluations.json")
+    with open(legacy_path, "wb") as f:
+        f.write(orjson.dumps([{"code_model": "old_1"}, {"code_model": "old_2"}]))
+
+    ModelEvaluator(log_path)
+    ModelEvaluator(log_path)
+    assert [evaluation["code_model"] for evaluation in ModelEvaluator.load_evaluations(log_path)] == ["old_1", "old_2"]
+    assert not os.path.exists(legacy_path) and os.path.exists(legacy_path + ".migrated")
+
+
+def test_legacy_json_log_is_not_converted_into_a_used_log(tmp_path):
+    log_path = str(tmp_path / "model_evaluations.jsonl")
+    legacy_path = str(tmp_path / "model_evaluations.json")
+    with open(log_path, "wb") as f:
+        f.write(orjson.dumps({"code_model": "new"}) + b"\n")
+    with open(legacy_path, "wb") as f:
+        f.write(orjson.dumps([{"code_model": "old_1"}]))
+
+    ModelEvaluator(log_path)
+    assert [evaluation["code_model"] for evaluation in ModelEvaluator.load_evaluations(log_path)] == ["new"]
+    assert os.path.exists(legacy_path)
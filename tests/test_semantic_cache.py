@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+import semantic_cache
+from semantic_cache import SemanticCache, ExactCache
+
+
+def _unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _wait_for_saves():
+    semantic_cache._save_pool.submit(lambda: None).result()
+
+
+def test_semantic_cache_hits_above_the_threshold(tmp_path):
+    cache = SemanticCache(str(tmp_path / "cache.npz"), threshold=0.9)
+    cache.add(_unit(1, 0), {"code": "x"})
+    assert cache.lookup(_unit(1, 0.1)) == {"code": "x"}
+    assert cache.lookup(_unit(1, 1)) is None
+    assert cache.lookup(_unit(1, 1), threshold=0.7) == {"code": "x"}
+
+
+def test_semantic_cache_latest_entry_wins_a_tie(tmp_path):
+    cache = SemanticCache(str(tmp_path / "cache.npz"))
+    cache.add(_unit(1, 0), "old")
+    cache.add(_unit(1, 0), "new")
+    assert cache.lookup(_unit(1, 0)) == "new"
+
+
+def test_semantic_cache_drops_the_oldest_entries(tmp_path):
+    cache = SemanticCache(str(tmp_path / "cache.npz"), max_entries=2)
+    cache.add(_unit(1, 0, 0), "a")
+    cache.add(_unit(0, 1, 0), "b")
+    cache.add(_unit(0, 0, 1), "c")
+    assert cache.lookup(_unit(1, 0, 0)) is None
+    assert cache.lookup(_unit(0, 1, 0)) == "b"
+    assert cache.lookup(_unit(0, 0, 1)) == "c"
+
+
+def test_semantic_cache_save_and_load(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    cache = SemanticCache(path, version="v1")
+    cache.add(_unit(1, 0), {"code": "print(' ')\n"})
+    cache.add(_unit(0, 1), ["a", "b"])
+    cache.save()
+    _wait_for_saves()
+
+    loaded = SemanticCache(path, version="v1")
+    assert loaded.lookup(_unit(1, 0)) == {"code": "print(' ')\n"}
+    assert loaded.lookup(_unit(0, 1)) == ["a", "b"]
+
+
+def test_semantic_cache_of_another_version_starts_empty(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    cache = SemanticCache(path, version="v1")
+    cache.add(_unit(1, 0), "result")
+    cache.save()
+    _wait_for_saves()
+
+    assert SemanticCache(path, version="v2").lookup(_unit(1, 0)) is None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_exact_cache_hit_and_miss(clock):
+    cache = ExactCache()
+    cache.add("prompt", {"code": "x"})
+    assert cache.get("prompt") == {"code": "x"}
+    assert cache.get("other prompt") is None
+
+
+def test_exact_cache_entries_expire(clock):
+    cache = ExactCache(ttl=10)
+    cache.add("prompt", "result")
+    clock[0] += 10
+    assert cache.get("prompt") == "result"
+    clock[0] += 1
+    assert cache.get("prompt") is None
+
+
+def test_exact_cache_evicts_least_recently_used(clock):
+    cache = ExactCache(max_entries=2)
+    cache.add("a", 1)
+    cache.add("b", 2)
+    cache.get("a")
+    cache.add("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_exact_cache_add_replaces_and_refreshes(clock):
+    cache = ExactCache(ttl=10, max_entries=2)
+    cache.add("a", 1)
+    cache.add("b", 2)
+    clock[0] += 5
+    cache.add("a", 10)
+    cache.add("c", 3)
+    assert cache.get("b") is None
+    clock[0] += 9
+    assert cache.get("a") == 10
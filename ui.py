@@ -0,0 +1,333 @@
+"""
+Streamlit rendering of generation results and of the session history.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Dict, Any, Iterator, Optional, Set
+
+import orjson
+import streamlit as st
+
+from feedback_manager import FeedbackManager
+from generation import GenerationProgress, Result
+
+# Directory generated code is saved to
+OUTPUT_DIR = "output"
+# Number of results kept in a session's history; older ones are archived to HISTORY_ARCHIVE_DIR
+HISTORY_LIMIT = 50
+# Number of history entries rendered initially, and added by each "Load more"
+HISTORY_PAGE_SIZE = 10
+# Each session archives into its own subdirectory of HISTORY_ARCHIVE_DIR
+HISTORY_ARCHIVE_DIR = os.path.join(OUTPUT_DIR, "history")
+
+# Created once per process rather than on every save
+os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+
+
+class StreamlitProgress(GenerationProgress):
+    """Displays run_generation's progress in a status widget of the page, which keeps the retry log afterwards."""
+
+    def __init__(self, max_retries: int):
+        """
+        Initialize the StreamlitProgress, creating its widgets at the current position of the page.
+
+        Args:
+            max_retries: Maximum number of attempts, shown in retry warnings
+        """
+        self.max_retries = max_retries
+        self.status_widget = st.status("Generating code...", expanded=False)
+        self.preview_placeholder = st.empty()
+        self.error_container = st.container()
+
+    def status(self, message: str):
+        self.status_widget.update(label=message)
+
+    def partial(self, code: str):
+        self.preview_placeholder.code(code, language="python")
+
+    def stream(self, chunks: Iterator[str]) -> str:
+        with self.preview_placeholder.container():
+            text = st.write_stream(chunks)
+        self.preview_placeholder.empty()
+        return str(text)
+
+    def retry(self, attempt: int, error_context: str, response: Any):
+        self.preview_placeholder.empty()
+        self.status_widget.update(label=f"Retry attempt {attempt}/{self.max_retries}...")
+        with self.status_widget:
+            if response is not None:
+                st.caption(f"Response from attempt {attempt}")
+                st.code(response)
+            st.info(f"**Previous attempt failed with error:**  \n{error_context}  \n**Retrying with this new knowledge.**")
+
+    def done(self):
+        self.preview_placeholder.empty()
+
+    def show_result(self, result: Result):
+        """Mark the status with the final outcome."""
+        if result.succeeded:
+            self.status_widget.update(label="Code Generated Successfully!", state="complete")
+            return
+
+        self.status_widget.update(label=f"Failed after {result.attempts} attempts", state="error")
+        with self.error_container:
+            st.error(f"**An error occurred:** {result.error[:300]}  \n**Please try again with a different prompt.**")
+            with st.expander("See detailed error"):
+                st.code(result.error_traceback)
+            if result.raw:
+                with st.expander("See the last response"):
+                    st.code(result.raw)
+
+
+def download_payload(cleaned_json: Dict[str, Any]) -> str:
+    """Contents of the file a code output is downloaded and saved as: the description as a docstring, then the code."""
+    return f"'''\n{cleaned_json['description']}\n'''\n{cleaned_json['code']}"
+
+
+def render_response(result: Result) -> Optional[str]:
+    """
+    Display a generated response, with a download button when it is a structured code output.
+    Returns: str: The download payload of a structured code output, to be reused for saving it
+    """
+    st.subheader("Response")
+    if not result.is_json:
+        st.warning("Unable to generate a structured response. Loading raw response.")
+        st.write(result.cleaned_json)
+        return None
+
+    cleaned_json = result.cleaned_json
+    payload = download_payload(cleaned_json)
+    if result.from_cache:
+        st.caption("Reused the response to a similar earlier prompt.")
+    st.markdown(f"**Description:** {cleaned_json['description']}")
+    if cleaned_json['code']:
+        st.code(cleaned_json['code'], language="python")
+        st.markdown(f"**Filename:** {cleaned_json['filename']}")
+        # Add a download button
+        st.download_button(
+            label=f"Download {cleaned_json['filename']}",
+            data=payload,
+            file_name=cleaned_json['filename'],
+            mime="text/plain",
+            on_click="ignore"
+        )
+    return payload
+
+
+def _write_output(path: Path, payload: str, outcome: Dict[str, Any]):
+    """Write a code output file on a background thread, recording any error in outcome."""
+    try:
+        # Explicit encoding and newlines, so non-ASCII code saves the same on every platform
+        path.write_text(payload, encoding="utf-8", newline="\n")
+    except Exception as e:
+        outcome["error"] = str(e)
+
+
+def save_response(cleaned_json: Dict[str, Any], payload: Optional[str] = None):
+    """
+    Save a code output to output/<filename> on a background thread, unless this session already saved the same
+    contents there. report_saves() displays the outcome once the write finished.
+    Args: cleaned_json: The code output
+          payload: Its download payload, if already built (see download_payload)
+    """
+    try:
+        if payload is None:
+            payload = download_payload(cleaned_json)
+        content_hash = hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+        if st.session_state.saved_hashes.get(cleaned_json['filename']) == content_hash:
+            st.info(f"'output/{cleaned_json['filename']}' is unchanged")
+            return
+
+        outcome = {"filename": cleaned_json['filename'], "hash": content_hash, "error": None}
+        path = Path(OUTPUT_DIR, cleaned_json['filename'])
+        thread = threading.Thread(target=_write_output, args=(path, payload, outcome), daemon=True)
+        thread.start()
+        st.session_state.pending_writes.append((thread, outcome))
+        st.session_state.saved_hashes[cleaned_json['filename']] = content_hash
+    except Exception as e:
+        st.error(f"There was an error generating the file: {str(e)[:200]}...")
+
+
+def report_saves():
+    """Display the outcome of the background writes of save_response that finished, keeping the running ones."""
+    running = []
+    for thread, outcome in st.session_state.pending_writes:
+        if thread.is_alive():
+            running.append((thread, outcome))
+            continue
+        thread.join()
+        if outcome["error"] is None:
+            st.success(f"Code saved to 'output/{outcome['filename']}'")
+            continue
+        st.error(f"There was an error generating the file: {outcome['error'][:200]}...")
+        # Let the same contents be saved again
+        if st.session_state.saved_hashes.get(outcome["filename"]) == outcome["hash"]:
+            del st.session_state.saved_hashes[outcome["filename"]]
+    st.session_state.pending_writes = running
+
+
+def submit_feedback(feedback_manager: FeedbackManager, rating, code_id, comment, chat_model, code_model,
+                    code=None, prompt=None, description=None):
+    """Record feedback for a result and remember that the session submitted it."""
+    feedback_success = feedback_manager.record_feedback(
+        rating, code_id, comment, chat_model, code_model, code=code, prompt=prompt, code_description=description
+    )
+    if feedback_success:
+        st.session_state.feedback_submitted = True
+    return feedback_success
+
+
+def init_history():
+    """Initialize the session history state."""
+    if 'history' not in st.session_state:
+        # History entries only hold a code ID, the filename and the description; the results themselves
+        # are kept once in the blob store, keyed by code ID, and fetched when an entry is opened
+        st.session_state.history = deque(maxlen=HISTORY_LIMIT)
+        st.session_state.code_blob_store = {}
+        st.session_state.archived_count = 0
+        st.session_state.history_shown = HISTORY_PAGE_SIZE
+        # Only this session's archives are listed, so no session sees another's generated code
+        st.session_state.archive_dir = os.path.join(HISTORY_ARCHIVE_DIR, uuid.uuid4().hex)
+        st.session_state.archived_shown = HISTORY_PAGE_SIZE
+
+
+def history_blob(code_id: str):
+    """The result stored for a history entry: its code output, or the raw response if it wasn't one."""
+    return st.session_state.code_blob_store.get(code_id)
+
+
+def add_to_history(entry, code_id: str, payload: Optional[str] = None):
+    """
+    Append a result to the session history, archiving the oldest one to disk once the history is full.
+    Args: entry: The code output, or the raw response if it wasn't one
+          code_id: Identifier of the result, used for its feedback
+          payload: The code output's download payload, stored with it so history reruns don't rebuild it
+    """
+    if payload is not None:
+        # A copy, as the code output may also be held by the response caches
+        entry = {**entry, "_download_payload": payload}
+    history = st.session_state.history
+    blob_store = st.session_state.code_blob_store
+    if len(history) == history.maxlen:
+        oldest = blob_store.pop(history[0]["code_id"], None)
+        try:
+            # Named by the entry's history number, so the names sort in archiving order
+            archive_name = f"{st.session_state.archived_count + 1:06d}-{history[0]['code_id']}.json"
+            if isinstance(oldest, dict):
+                oldest = {key: value for key, value in oldest.items() if key != "_download_payload"}
+            os.makedirs(st.session_state.archive_dir, exist_ok=True)
+            Path(st.session_state.archive_dir, archive_name).write_bytes(orjson.dumps(oldest, option=orjson.OPT_INDENT_2))
+        except Exception as e:
+            print(f"Error archiving a history entry: {e}")
+        st.session_state.archived_count += 1
+
+    blob_store[code_id] = entry
+    if isinstance(entry, dict):
+        history.append({"code_id": code_id, "filename": entry.get("filename"), "description": entry.get("description")})
+    else:
+        history.append({"code_id": code_id, "filename": None, "description": str(entry)[:200]})
+
+
+@st.cache_data(show_spinner=False, max_entries=HISTORY_LIMIT)
+def load_archived_entry(path: str):
+    """Load an archived history entry; archives are written once and never change."""
+    return orjson.loads(Path(path).read_bytes())
+
+
+@st.fragment
+def render_history_entry(number: int, summary: Dict[str, Any], feedback_manager: FeedbackManager,
+                         recorded_ids: Set[str], chat_model: str, code_model: str):
+    """
+    Render one history entry. As a fragment, interacting with it reruns only this entry.
+    recorded_ids holds the code IDs with recorded feedback, as looked up for the whole history by render_history.
+    """
+    code_id = summary["code_id"]
+    title = f"{summary['filename']} - {summary['description']}" if summary["filename"] else summary["description"]
+    with st.expander(f"#{number}: {title}"):
+        # The result and the rating widgets are only fetched and created for the entries the user opens
+        if not st.toggle("Show code", key=f"show_code_{code_id}"):
+            return
+        entry = history_blob(code_id)
+        if not isinstance(entry, dict):
+            st.write(entry)
+            return
+
+        st.code(entry['code'], language="python")
+        st.download_button(
+            label=f"Download {entry['filename']}",
+            data=entry.get('_download_payload') or download_payload(entry),
+            file_name=entry['filename'],
+            mime="text/plain",
+            key=f"download_button_{code_id}",
+            on_click="ignore"
+        )
+
+        # Add feedback for historical items
+        if code_id in recorded_ids:
+            st.success("Feedback already recorded for this response.")
+        else:
+            st.write("Rate this code:")
+            feedback_comment = st.text_area("Additional comments (optional):", key=f"history_comment_{code_id}")
+            # A single star widget instead of a button per rating; it returns the 0-based star index
+            rating = st.feedback("stars", key=f"history_rating_{code_id}")
+            if rating is not None:
+                feedback_success = submit_feedback(
+                    feedback_manager, rating + 1, code_id, feedback_comment,
+                    chat_model, code_model,
+                    code=entry['code'],
+                    prompt='Unavailable',
+                    description=entry['description']
+                )
+                if feedback_success:
+                    # Fragment reruns get the same set, so this entry shows as rated from now on
+                    recorded_ids.add(code_id)
+                    st.success("Feedback recorded!")
+                else:
+                    st.error("Error recording feedback. Please try again.")
+
+
+def render_history(feedback_manager: FeedbackManager, chat_model: str, code_model: str):
+    """Render the latest entries of the session history, if it isn't empty, with a button loading older ones."""
+    if not st.session_state.history:
+        return
+
+    st.markdown("---")
+    st.subheader("Model History")
+    history = st.session_state.history
+    # Only the latest entries are rendered, so each rerun creates a bounded number of widgets
+    first = max(0, len(history) - st.session_state.history_shown)
+    if first > 0 and st.button(f"Load more ({first} older)", key="history_load_more"):
+        st.session_state.history_shown += HISTORY_PAGE_SIZE
+        first = max(0, len(history) - st.session_state.history_shown)
+    shown = [history[i] for i in range(first, len(history))]
+    recorded_ids = feedback_manager.bulk_is_recorded(summary["code_id"] for summary in shown)
+    for number, summary in enumerate(shown, st.session_state.archived_count + first + 1):
+        render_history_entry(number, summary, feedback_manager, recorded_ids, chat_model, code_model)
+
+
+def render_archived_history():
+    """Render the latest entries this session archived to disk, with a button loading older ones."""
+    archive_dir = st.session_state.archive_dir
+    archive_names = sorted(os.listdir(archive_dir), reverse=True) if os.path.isdir(archive_dir) else []
+    if not archive_names:
+        return
+
+    st.markdown("---")
+    st.subheader("Archived History")
+    # Like render_history, only a page of entries is read and rendered at a time
+    older = len(archive_names) - st.session_state.archived_shown
+    if older > 0 and st.button(f"Load more ({older} older)", key="archived_load_more"):
+        st.session_state.archived_shown += HISTORY_PAGE_SIZE
+    for archive_name in archive_names[:st.session_state.archived_shown]:
+        number = int(archive_name.split("-", 1)[0])
+        entry = load_archived_entry(os.path.join(archive_dir, archive_name))
+        if isinstance(entry, dict) and 'code' in entry:
+            with st.expander(f"#{number}: {entry.get('filename')} - {entry.get('description')}"):
+                st.code(entry['code'], language="python")
+        else:
+            with st.expander(f"#{number}: {str(entry)[:200]}"):
+                st.write(entry)